@@ -26,11 +26,11 @@ Implementation Notes
 
 """
 try:
-    from typing import Union, Tuple, Any, List, Optional, Dict, BinaryIO
+    from typing import Union, Tuple, Any, List, Optional, Dict, BinaryIO, Callable
 except ImportError:
     pass
 
-from .midi_message import MIDIMessage
+from .midi_message import MIDIMessage, MIDIUnknownEvent, MessagePool, channel_mask
 
 __version__ = "0.0.0+auto.0"
 __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_MIDI.git"
@@ -41,6 +41,8 @@ class MIDI:
 
     :param midi_in: an object which implements ``read(length)``,
         set to ``usb_midi.ports[0]`` for USB MIDI, default None.
+        If it also implements ``readinto(buffer)`` that is used to read
+        directly into the input buffer.
     :param midi_out: an object which implements ``write(buffer, length)``,
         set to ``usb_midi.ports[1]`` for USB MIDI, default None.
     :param in_channel: The input channel(s).
@@ -52,6 +54,23 @@ class MIDI:
         used by ``send`` if no channel is specified,
         defaults to 0 (MIDI Channel 1).
     :param int in_buf_size: Maximum size of input buffer in bytes, default 30.
+    :param int pool_size: Number of reusable message objects kept per message type,
+        default 0 for a new object per message. See :class:MessagePool,
+        a message received is only valid until ``pool_size`` more messages have been
+        received.
+    :param sysex_handler: A function called as ``sysex_handler(data, first, last)``
+        to stream System Exclusive messages of any length, default None.
+        ``data`` is a ``memoryview`` of the SysEx bytes received since the previous
+        call, including the 0xF0 and 0xF7 framing bytes, and is only valid during
+        the call. ``first`` is True for the chunk starting with 0xF0 and ``last`` is
+        True for the final chunk, which does not end with 0xF7 if the message was
+        cut short by another status byte. SysEx messages are not returned
+        by ``receive`` when this is set.
+    :param realtime_handler: A function called as ``realtime_handler(status)`` with the
+        status byte of each System Real-Time message (0xF8-0xFF) as soon as it is read,
+        default None. Without a handler they are returned by ``receive`` ahead of
+        other messages. Either way they are taken out of the input before parsing,
+        as they may arrive between the bytes of another message.
     :param bool debug: Debug mode, default False.
 
     """
@@ -64,6 +83,9 @@ class MIDI:
         in_channel: Optional[Union[int, Tuple[int, ...]]] = None,
         out_channel: int = 0,
         in_buf_size: int = 30,
+        pool_size: int = 0,
+        sysex_handler: Optional[Callable[[memoryview, bool, bool], None]] = None,
+        realtime_handler: Optional[Callable[[int], None]] = None,
         debug: bool = False
     ):
         if midi_in is None and midi_out is None:
@@ -75,9 +97,28 @@ class MIDI:
         self._out_channel = out_channel
         self.out_channel = out_channel
         self._debug = debug
-        # This input buffer holds what has been read from midi_in
-        self._in_buf = bytearray(0)
+        # This input buffer holds what has been read from midi_in.
+        # It is allocated once and used as a ring with a read index (next
+        # byte to parse) and a write index (next byte to fill), messages are
+        # parsed in place through a memoryview. When the write index reaches
+        # the end any unparsed bytes are moved back to the start.
+        self._in_buf = bytearray(in_buf_size)
+        self._in_view = memoryview(self._in_buf)
         self._in_buf_size = in_buf_size
+        self._in_read = 0
+        self._in_write = 0
+        self._readinto = getattr(midi_in, "readinto", None)
+        self._pool = MessagePool(pool_size) if pool_size > 0 else None
+        # A SysEx being streamed to the handler, all of its bytes up to
+        # the read index have been passed on already
+        self._sysex_handler = sysex_handler
+        self._sysex_active = False
+        # System Real-Time status bytes waiting to be returned by receive(),
+        # as each message has no data one object per status byte is reused
+        self._realtime_handler = realtime_handler
+        self._realtime_buf = bytearray(8)
+        self._realtime_num = 0
+        self._realtime_msgs = {}
         self._outbuf = bytearray(4)
         self._skipped_bytes = 0
 
@@ -100,6 +141,13 @@ class MIDI:
             self._in_channel = channel
         else:
             raise RuntimeError("Invalid input channel")
+        self._in_channel_mask = channel_mask(self._in_channel)
+
+    @property
+    def in_channel_mask(self) -> int:
+        """The incoming MIDI channel(s) as a 16 bit mask, bit n is set
+        if ``in_channel`` includes channel n."""
+        return self._in_channel_mask
 
     @property
     def out_channel(self) -> int:
@@ -122,29 +170,190 @@ class MIDI:
         :returns MIDIMessage object: Returns object or None for nothing.
         """
         ### could check _midi_in is an object OR correct object OR correct interface here?
+        self._fill_in_buf()
+        if self._realtime_num:
+            return self._pop_realtime()
+        return self._parse_in_buf()
+
+    def receive_many(self) -> List[MIDIMessage]:
+        """Read messages from MIDI port, store them in internal read buffer, then parse that data
+        and return every complete MIDI message (event) in it.
+        The port is read again only if the previous read filled the buffer, so this
+        maintains the blocking characteristics of the midi_in port.
+        With a ``pool_size`` at most that many messages are returned.
+
+        :returns list: MIDIMessage objects in the order received, empty for nothing.
+        """
+        msgs = []
+        limit = self._pool.size if self._pool is not None else -1
+        while True:
+            filled = self._fill_in_buf()
+            while self._realtime_num:
+                msgs.append(self._pop_realtime())
+            # A SysEx is only streamed before any message of the batch, so
+            # the handler and the caller see everything in the order received
+            while (
+                len(msgs) != limit
+                and (msg := self._parse_in_buf(not msgs)) is not None
+            ):
+                msgs.append(msg)
+            if not filled or len(msgs) == limit or self._at_sysex():
+                return msgs
+
+    def _fill_in_buf(self) -> bool:
+        # Returns True if the read used all the free space in the buffer
+        if self._in_write == self._in_buf_size and self._in_read > 0:
+            self._rewind_in_buf()
+
         # If the buffer here is not full then read as much as we can fit from
         # the input port
-        if len(self._in_buf) < self._in_buf_size:
-            bytes_in = self._midi_in.read(self._in_buf_size - len(self._in_buf))
-            if bytes_in:
-                if self._debug:
-                    print("Receiving: ", [hex(i) for i in bytes_in])
-                self._in_buf.extend(bytes_in)
-                del bytes_in
-
-        (msg, endplusone, skipped) = MIDIMessage.from_message_bytes(
-            self._in_buf, self._in_channel
+        if self._in_write < self._in_buf_size:
+            self._read_in()
+            return self._in_write == self._in_buf_size
+
+        return False
+
+    def _at_sysex(self) -> bool:
+        # True if the next bytes to parse are to be streamed as SysEx
+        return self._sysex_handler is not None and (
+            self._sysex_active
+            or self._in_read < self._in_write
+            and self._in_buf[self._in_read] == 0xF0
         )
-        if endplusone != 0:
-            # This is not particularly efficient as it's copying most of bytearray
-            # and deleting old one
-            self._in_buf = self._in_buf[endplusone:]
 
-        self._skipped_bytes += skipped
+    def _parse_in_buf(self, stream_sysex: bool = True) -> Optional[MIDIMessage]:
+        stop_status = None
+        if self._sysex_handler is not None:
+            if stream_sysex:
+                self._stream_sysex()
+            stop_status = 0xF0
+
+        while True:
+            (msg, endplusone, skipped) = MIDIMessage.from_message_bytes(
+                self._in_view,
+                self._in_channel,
+                self._in_read,
+                self._in_write,
+                self._pool,
+                self._in_channel_mask,
+                stop_status,
+            )
+            self._in_read = endplusone
+            self._skipped_bytes += skipped
+            if (
+                msg is None
+                and stream_sysex
+                and stop_status is not None
+                and endplusone < self._in_write
+                and self._in_buf[endplusone] == stop_status
+            ):
+                # Stopped at the start of a SysEx
+                self._stream_sysex()
+                continue
+            break
+
+        if self._in_read == self._in_write:
+            self._in_read = 0
+            self._in_write = 0
 
         # msg could still be None at this point, e.g. in middle of monster SysEx
         return msg
 
+    def _stream_sysex(self) -> None:
+        # Pass the SysEx bytes at the read index to the handler, scanning
+        # only the bytes received since the last call
+        buf = self._in_buf
+        read = self._in_read
+        write = self._in_write
+        first = not self._sysex_active
+        if first:
+            if read == write or buf[read] != 0xF0:
+                return
+            self._sysex_active = True
+
+        idx = read + 1 if first else read
+        while idx < write and not buf[idx] & 0x80:
+            idx += 1
+
+        # Any status byte ends the message but only 0xF7 belongs to it
+        last = idx < write
+        if last:
+            if buf[idx] == 0xF7:
+                idx += 1
+            self._sysex_active = False
+
+        if idx > read or last:
+            self._sysex_handler(self._in_view[read:idx], first, last)
+
+        self._in_read = idx
+        if self._in_read == self._in_write:
+            self._in_read = 0
+            self._in_write = 0
+
+    def _read_in(self) -> None:
+        write = self._in_write
+        if self._readinto is not None:
+            num = self._readinto(self._in_view[write:])
+        else:
+            bytes_in = self._midi_in.read(self._in_buf_size - write)
+            num = len(bytes_in) if bytes_in else 0
+            if num:
+                self._in_buf[write : write + num] = bytes_in
+            del bytes_in
+
+        if num:
+            if self._debug:
+                print(
+                    "Receiving: ",
+                    [hex(i) for i in self._in_buf[write : write + num]],
+                )
+            self._in_write = self._extract_realtime(write, write + num)
+
+    def _extract_realtime(self, start: int, end: int) -> int:
+        # Take System Real-Time bytes out of buf[start:end] without disturbing
+        # any message they interrupt, returns the new end of the data
+        buf = self._in_buf
+        dest = start
+        for idx in range(start, end):
+            status = buf[idx]
+            if status >= 0xF8:
+                if self._realtime_handler is not None:
+                    self._realtime_handler(status)
+                elif self._realtime_num < len(self._realtime_buf):
+                    self._realtime_buf[self._realtime_num] = status
+                    self._realtime_num += 1
+                else:
+                    self._skipped_bytes += 1
+            else:
+                if dest != idx:
+                    buf[dest] = status
+                dest += 1
+        return dest
+
+    def _pop_realtime(self) -> MIDIMessage:
+        status = self._realtime_buf[0]
+        self._realtime_num -= 1
+        for idx in range(self._realtime_num):
+            self._realtime_buf[idx] = self._realtime_buf[idx + 1]
+
+        msg = self._realtime_msgs.get(status)
+        if msg is None:
+            entry = MIDIMessage._status_to_class[status]
+            msg = entry[0]() if entry is not None else MIDIUnknownEvent(status)
+            self._realtime_msgs[status] = msg
+        return msg
+
+    def _rewind_in_buf(self) -> None:
+        # Move the unparsed bytes to the start of the buffer, this is done
+        # a byte at a time as the two regions can overlap
+        buf = self._in_buf
+        read = self._in_read
+        size = self._in_write - read
+        for idx in range(size):
+            buf[idx] = buf[read + idx]
+        self._in_read = 0
+        self._in_write = size
+
     def send(self, msg: MIDIMessage, channel: Optional[int] = None) -> None:
         """Sends a MIDI message.
 
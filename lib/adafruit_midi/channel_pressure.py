@@ -46,5 +46,12 @@ class ChannelPressure(MIDIMessage):
     def from_bytes(cls, msg_bytes):
         return cls(msg_bytes[1], channel=msg_bytes[0] & cls.CHANNELMASK)
 
+    def _refill(self, buf, idx):
+        pressure = buf[idx + 1]
+        if pressure > 127:
+            self._raise_valueerror_oor()
+        self.pressure = pressure
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 ChannelPressure.register_message_type()
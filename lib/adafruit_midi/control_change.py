@@ -51,5 +51,14 @@ class ControlChange(MIDIMessage):
     def from_bytes(cls, msg_bytes):
         return cls(msg_bytes[1], msg_bytes[2], channel=msg_bytes[0] & cls.CHANNELMASK)
 
+    def _refill(self, buf, idx):
+        control = buf[idx + 1]
+        value = buf[idx + 2]
+        if control > 127 or value > 127:
+            self._raise_valueerror_oor()
+        self.control = control
+        self.value = value
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 ControlChange.register_message_type()
@@ -12,7 +12,11 @@ When individual messages are imported they register themselves with
 by the parser, :func:from_message_bytes.
 
 Large messages like :class:SystemExclusive can only be parsed if they fit
-within the input buffer in :class:MIDI.
+within the input buffer in :class:MIDI, unless it streams them to a
+``sysex_handler``.
+
+A :class:MessagePool can be given to the parser to reuse message objects
+rather than creating a new one for every channel voice message.
 
 
 * Author(s): Kevin J. Walters
@@ -48,6 +52,21 @@ def channel_filter(
     raise ValueError("Incorrect type for channel_spec" + str(type(channel_spec)))
 
 
+def channel_mask(channel_spec: Optional[Union[int, Tuple[int, ...]]]) -> int:
+    """
+    Utility function to return a 16 bit mask with bit n set iff channel n matches
+    channel_spec.
+    """
+    if isinstance(channel_spec, int):
+        return 1 << channel_spec
+    if isinstance(channel_spec, tuple):
+        mask = 0
+        for channel in channel_spec:
+            mask |= 1 << channel
+        return mask
+    raise ValueError("Incorrect type for channel_spec" + str(type(channel_spec)))
+
+
 def note_parser(note: Union[int, str]) -> int:
     """If note is a string then it will be parsed and converted to a MIDI note (key) number, e.g.
     "C4" will return 60, "C#4" will return 61. If note is not a string it will simply be returned.
@@ -95,6 +114,11 @@ class MIDIMessage:
     CHANNELMASK = 0x0F
     ENDSTATUS = None
 
+    # Message types which a MessagePool can reuse implement
+    # _refill(buf, idx) to update the object in place from the wire
+    # bytes at buf[idx], raising ValueError if the data is out of range
+    _refill = None
+
     # Commonly used exceptions to save memory
     @staticmethod
     def _raise_valueerror_oor() -> None:
@@ -107,6 +131,12 @@ class MIDIMessage:
         Tuple[Tuple[Optional[bytes], Optional[int]], "MIDIMessage"]
     ] = []
 
+    # Indexed by status byte, each element is (class, LENGTH) for the
+    # most specific registered match or None for an unknown status.
+    # This is filled in by register_message_type() so the parser can
+    # resolve a status byte without walking _statusandmask_to_class
+    _status_to_class: List[Optional[Tuple["MIDIMessage", int]]] = [None] * 256
+
     def __init__(self, *, channel: Optional[int] = None) -> None:
         self._channel = channel  # dealing with pylint inadequacy
         self.channel = channel
@@ -140,6 +170,14 @@ class MIDIMessage:
             insert_idx, ((cls._STATUS, cls._STATUSMASK), cls)
         )
 
+        # Same precedence as the list: more specific masks win and
+        # for equal masks the first one registered is kept
+        for status in range(0x80, 0x100):
+            if status & cls._STATUSMASK == cls._STATUS:
+                entry = MIDIMessage._status_to_class[status]
+                if entry is None or cls._STATUSMASK > entry[0]._STATUSMASK:
+                    MIDIMessage._status_to_class[status] = (cls, cls.LENGTH)
+
     # pylint: disable=too-many-arguments
     @classmethod
     def _search_eom_status(
@@ -181,18 +219,16 @@ class MIDIMessage:
         complete_msg = False
         bad_termination = False
 
-        # Rummage through our list looking for a status match
-        for status_mask, msgclass in MIDIMessage._statusandmask_to_class:
-            masked_status = status & status_mask[1]
-            if status_mask[0] == masked_status:
-                known_msg = True
-                # Check there's enough left to parse a complete message
-                # this value can be changed later for a var. length msgs
-                complete_msg = len(buf) - msgstartidx >= msgclass.LENGTH
-                if not complete_msg:
-                    break
-
-                if msgclass.LENGTH < 0:  # indicator of variable length message
+        # One lookup replaces a search through _statusandmask_to_class
+        entry = MIDIMessage._status_to_class[status]
+        if entry is not None:
+            msgclass, length = entry
+            known_msg = True
+            # Check there's enough left to parse a complete message
+            # this value can be changed later for a var. length msgs
+            complete_msg = endidx + 1 - msgstartidx >= length
+            if complete_msg:
+                if length < 0:  # indicator of variable length message
                     (
                         msgendidxplusone,
                         terminated_msg,
@@ -203,8 +239,7 @@ class MIDIMessage:
                     if not terminated_msg:
                         complete_msg = False
                 else:  # fixed length message
-                    msgendidxplusone = msgstartidx + msgclass.LENGTH
-                break
+                    msgendidxplusone = msgstartidx + length
 
         return (
             msgclass,
@@ -218,21 +253,41 @@ class MIDIMessage:
     # pylint: disable=too-many-locals,too-many-branches
     @classmethod
     def from_message_bytes(
-        cls, midibytes: bytearray, channel_in: Optional[Union[int, Tuple[int, ...]]]
+        cls,
+        midibytes: bytearray,
+        channel_in: Optional[Union[int, Tuple[int, ...]]],
+        start: int = 0,
+        end: Optional[int] = None,
+        pool: Optional["MessagePool"] = None,
+        in_channel_mask: Optional[int] = None,
+        stop_status: Optional[int] = None,
     ) -> Tuple[Optional["MIDIMessage"], int, int]:
         """Create an appropriate object of the correct class for the
         first message found in some MIDI bytes filtered by channel_in.
 
+        Only ``midibytes[start:end]`` is parsed, this allows a
+        ``memoryview`` over a larger buffer to be used without slicing it.
+        If a :class:MessagePool is given it supplies the object where the
+        message type supports it. in_channel_mask is channel_in compiled by
+        :func:channel_mask (channel_in None is all channels), messages on
+        other channels are skipped before any object is created for them.
+        Parsing stops at a message starting with stop_status, returning
+        (None, index of that status byte, skipped), to let the caller
+        handle it.
+
         Returns (messageobject, endplusone, skipped)
         or for no messages, partial messages or messages for other channels
-        (None, endplusone, skipped).
+        (None, endplusone, skipped). endplusone is an index into midibytes.
         """
-        endidx = len(midibytes) - 1
+        endidx = (len(midibytes) if end is None else end) - 1
         skipped = 0
         preamble = True
 
-        msgstartidx = 0
-        msgendidxplusone = 0
+        if in_channel_mask is None:
+            in_channel_mask = 0xFFFF if channel_in is None else channel_mask(channel_in)
+
+        msgstartidx = start
+        msgendidxplusone = start
         while True:
             msg = None
             # Look for a status byte
@@ -247,6 +302,9 @@ class MIDIMessage:
             if msgstartidx > endidx:
                 return (None, endidx + 1, skipped)
 
+            if midibytes[msgstartidx] == stop_status:
+                return (None, msgstartidx, skipped)
+
             # Try and match the status byte found in midibytes
             (
                 msgclass,
@@ -260,13 +318,22 @@ class MIDIMessage:
             )
             channel_match_orna = True
             if complete_message and not bad_termination:
-                try:
-                    msg = msgclass.from_bytes(midibytes[msgstartidx:msgendidxplusone])
-                    if msg.channel is not None:
-                        channel_match_orna = channel_filter(msg.channel, channel_in)
-
-                except (ValueError, TypeError) as ex:
-                    msg = MIDIBadEvent(midibytes[msgstartidx:msgendidxplusone], ex)
+                # Channel messages have the channel in the status byte
+                if status < 0xF0 and not in_channel_mask >> (status & 0x0F) & 1:
+                    channel_match_orna = False
+                else:
+                    try:
+                        if pool is not None and msgclass._refill is not None:
+                            msg = pool.get(msgclass, midibytes, msgstartidx)
+                        else:
+                            msg = msgclass.from_bytes(
+                                midibytes[msgstartidx:msgendidxplusone]
+                            )
+
+                    except (ValueError, TypeError) as ex:
+                        msg = MIDIBadEvent(
+                            midibytes[msgstartidx:msgendidxplusone], ex
+                        )
 
             # break out of while loop for a complete message on good channel
             # or we have one we do not know about
@@ -321,6 +388,49 @@ class MIDIMessage:
     __repr__ = __str__
 
 
+class MessagePool:
+    """A small pool of reusable message objects for the parser.
+
+    Up to ``size`` objects are kept for each message type which supports
+    it and they are handed out in turn, so a parsed message is only valid
+    until ``size`` more messages of the same type have been parsed.
+    Objects are created the first time they are needed, after that parsing
+    a channel voice message creates no new message object. Parsing still
+    allocates the small result tuples of ``from_message_bytes()`` and
+    ``_match_message_status()``, and ``MIDI`` slices a ``memoryview`` for
+    each read from its input port.
+
+    :param int size: Number of objects kept per message type, default 4.
+    """
+
+    def __init__(self, size: int = 4) -> None:
+        self.size = size
+        self._objects = {}
+        self._next = {}
+        self.allocations = 0
+        """Number of message objects the pool has created. Other heap
+        allocations made while parsing are not counted."""
+
+    def get(self, msgclass: "MIDIMessage", buf: bytearray, idx: int) -> "MIDIMessage":
+        """Return an object of msgclass filled in from the message at buf[idx]."""
+        objects = self._objects.get(msgclass)
+        if objects is None:
+            objects = []
+            self._objects[msgclass] = objects
+
+        slot = self._next.get(msgclass, 0)
+        if slot < len(objects):
+            msg = objects[slot]
+            msg._refill(buf, idx)  # pylint: disable=protected-access
+        else:
+            msg = msgclass.from_bytes(buf[idx : idx + msgclass.LENGTH])
+            objects.append(msg)
+            self.allocations += 1
+
+        self._next[msgclass] = (slot + 1) % self.size
+        return msg
+
+
 # DO NOT try to register these messages
 class MIDIUnknownEvent(MIDIMessage):
     """An unknown MIDI message.
@@ -58,5 +58,14 @@ class NoteOff(MIDIMessage):  # pylint: disable=duplicate-code
     def from_bytes(cls, msg_bytes):
         return cls(msg_bytes[1], msg_bytes[2], channel=msg_bytes[0] & cls.CHANNELMASK)
 
+    def _refill(self, buf, idx):
+        note = buf[idx + 1]
+        velocity = buf[idx + 2]
+        if note > 127 or velocity > 127:
+            self._raise_valueerror_oor()
+        self.note = note
+        self.velocity = velocity
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 NoteOff.register_message_type()
@@ -55,5 +55,13 @@ class PitchBend(MIDIMessage):
             msg_bytes[2] << 7 | msg_bytes[1], channel=msg_bytes[0] & cls.CHANNELMASK
         )
 
+    def _refill(self, buf, idx):
+        lsb = buf[idx + 1]
+        msb = buf[idx + 2]
+        if lsb > 127 or msb > 127:
+            self._raise_valueerror_oor()
+        self.pitch_bend = msb << 7 | lsb
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 PitchBend.register_message_type()
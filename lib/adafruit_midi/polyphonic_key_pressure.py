@@ -51,5 +51,14 @@ class PolyphonicKeyPressure(MIDIMessage):
     def from_bytes(cls, msg_bytes):
         return cls(msg_bytes[1], msg_bytes[2], channel=msg_bytes[0] & cls.CHANNELMASK)
 
+    def _refill(self, buf, idx):
+        note = buf[idx + 1]
+        pressure = buf[idx + 2]
+        if note > 127 or pressure > 127:
+            self._raise_valueerror_oor()
+        self.note = note
+        self.pressure = pressure
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 PolyphonicKeyPressure.register_message_type()
@@ -46,5 +46,12 @@ class ProgramChange(MIDIMessage):
     def from_bytes(cls, msg_bytes):
         return cls(msg_bytes[1], channel=msg_bytes[0] & cls.CHANNELMASK)
 
+    def _refill(self, buf, idx):
+        patch = buf[idx + 1]
+        if patch > 127:
+            self._raise_valueerror_oor()
+        self.patch = patch
+        self._channel = buf[idx] & self.CHANNELMASK
+
 
 ProgramChange.register_message_type()
@@ -23,6 +23,11 @@ __repo__ = "https://github.com/adafruit/Adafruit_CircuitPython_USB_Host_MIDI.git
 
 DIR_IN = 0x80
 
+# Number of MIDI bytes carried by a 4 byte USB-MIDI event packet indexed by
+# its Code Index Number (low nibble of the packet header), 0 for reserved
+# CINs and for the all zero padding at the end of a transfer
+CIN_LENGTH = b"\x00\x00\x02\x03\x03\x01\x02\x03\x03\x03\x03\x03\x02\x02\x03\x01"
+
 
 class MIDI:
     """
@@ -42,9 +47,13 @@ class MIDI:
         self.device = device
         self.timeout_ms = round(timeout * 1000) if timeout else 0
 
+        # The last bulk transfer, a sequence of 4 byte event packets.
+        # _packet is the offset of the current packet, _offset counts the
+        # MIDI bytes of that packet already returned by read().
         self.buf = bytearray(64)
-        self.start = 0
-        self._remaining = 0
+        self._packet = 0
+        self._packet_end = 0
+        self._offset = 0
 
         config_descriptor = adafruit_usb_host_descriptors.get_configuration_descriptor(
             device, 0
@@ -80,6 +89,55 @@ class MIDI:
         device.set_configuration()
         device.detach_kernel_driver(self.interface_number)
 
+    def _receive(self):
+        # Start a new bulk transfer, returns False if nothing arrived
+        try:
+            n = self.device.read(self.in_ep, self.buf, self.timeout_ms)
+        except usb.core.USBTimeoutError:
+            return False
+        self._packet = 0
+        self._packet_end = n & ~3
+        self._offset = 0
+        return True
+
+    def _event_size(self):
+        # Skip to the first packet with MIDI bytes left in the current
+        # transfer and return its event size, or 0 at the end of the transfer
+        while self._packet < self._packet_end:
+            size = CIN_LENGTH[self.buf[self._packet] & 0x0F]
+            if self._offset < size:
+                return size
+            self._packet += 4
+            self._offset = 0
+        return 0
+
+    def _next_event_size(self):
+        # As _event_size but starts one new transfer if the current one is used up
+        size = self._event_size()
+        if size == 0 and self._receive():
+            size = self._event_size()
+        return size
+
+    @property
+    def in_waiting(self):
+        """The number of MIDI bytes left from the last USB transfer.
+        These can be read without starting another transfer."""
+        n = 0
+        offset = self._offset
+        for packet in range(self._packet, self._packet_end, 4):
+            size = CIN_LENGTH[self.buf[packet] & 0x0F]
+            if offset < size:
+                n += size - offset
+            offset = 0
+        return n
+
+    @property
+    def event_waiting(self):
+        """True if the last USB transfer has another event to read without
+        starting another transfer. Unlike ``in_waiting`` this takes
+        constant time."""
+        return self._packet < self._packet_end
+
     def read(self, size):
         """
         Read bytes.  If ``nbytes`` is specified then read at most that many
@@ -87,6 +145,10 @@ class MIDI:
         times out. Providing the number of bytes expected is highly recommended
         because it will be faster. If no bytes are read, return ``None``.
 
+        The Cable Number and Code Index Number header of every USB-MIDI event
+        packet is removed, so only MIDI bytes are returned. At most one USB
+        transfer (up to 16 events) is read per call.
+
         .. note:: When no bytes are read due to a timeout, this function returns ``None``.
           This matches the behavior of `io.RawIOBase.read` in Python 3, but
           differs from pyserial which returns ``b''`` in that situation.
@@ -94,30 +156,52 @@ class MIDI:
         :return: Data read
         :rtype: bytes or None
         """
-
-        if self._remaining == 0:
-            try:
-                n = self.device.read(self.in_ep, self.buf, self.timeout_ms)
-                self._remaining = n - 1
-                self.start = 1
-            except usb.core.USBTimeoutError:
-                pass
-        size = min(size, self._remaining)
-        b = self.buf[self.start : self.start + size]
-        self.start += size
-        self._remaining -= size
-        return b
+        b = bytearray(size)
+        n = self.readinto(b)
+        if n == 0:
+            return None
+        return b[:n] if n < size else b
+
+    def read_event(self, buf):
+        """Read the MIDI bytes of the next USB-MIDI event into ``buf``,
+        which must have room for 3 bytes. An event is always a complete MIDI
+        message except for SysEx, which is split into events of up to 3 bytes.
+
+        :return: number of bytes stored into ``buf``, 0 if there is no event
+        :rtype: int
+        """
+        event_size = self._next_event_size()
+        if event_size == 0:
+            return 0
+        start = self._packet + 1 + self._offset
+        n = event_size - self._offset
+        for i in range(n):
+            buf[i] = self.buf[start + i]
+        self._packet += 4
+        self._offset = 0
+        # Skip the empty packets, so event_waiting is exact
+        self._event_size()
+        return n
 
     def readinto(self, buf):
         """Read bytes into the ``buf``. Read at most ``len(buf)`` bytes.
+        The bytes are copied straight from the USB transfer buffer, nothing
+        is allocated.
 
         :return: number of bytes read and stored into ``buf``
         :rtype: int or None (on a non-blocking error)
         """
-        b = self.read(len(buf))
-        n = len(b)
-        if n:
-            buf[:] = b
+        size = len(buf)
+        n = 0
+        event_size = self._next_event_size()
+        while event_size and n < size:
+            start = self._packet + 1 + self._offset
+            end = start + min(event_size - self._offset, size - n)
+            for i in range(start, end):
+                buf[n] = self.buf[i]
+                n += 1
+            self._offset += end - start
+            event_size = self._event_size()
         return n
 
     def __repr__(self):
@@ -16,6 +16,12 @@
 #            Pitch bend and modulation wheel are available.
 #     1.0.2: 12/12/2024
 #            Select load MIDI settings file in only existings.
+#
+# LIBRARIES: copy to /lib in the CIRCUITPY drive
+#   In this repository: adafruit_midi, adafruit_ssd1306, adafruit_framebuf
+#   From the Adafruit CircuitPython Library Bundle (9.x):
+#     asyncio       : for the scheduled tasks (not built in CircuitPython)
+#     adafruit_ticks: required by asyncio
 ################################################################
 # COMMANDS:
 #  CH/ch: change MIDI channel to edit
@@ -49,9 +55,11 @@ from board import *
 import digitalio
 from busio import UART			# for UART MIDI
 from busio import I2C			# for I2C
-from time import sleep
+from time import sleep, monotonic_ns
 import os, re
 import json
+import asyncio					# from the Library Bundle, needs adafruit_ticks
+import supervisor
 
 import usb_midi					# for USB MIDI
 import adafruit_midi
@@ -63,6 +71,20 @@ from adafruit_midi.program_change import ProgramChange
 
 import adafruit_ssd1306			# for SSD1306 OLED Display
 
+#################
+### Time helpers
+#################
+# supervisor.ticks_ms() wraps around at 2**29 milliseconds
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+# Milliseconds from t0 to t1 (negative if t1 is before t0)
+def ticks_diff(t1, t0):
+    diff = (t1 - t0) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
 #####################
 ### Unit-MIDI class
 #####################
@@ -106,15 +128,8 @@ class MIDIUnit_class:
                         return instrument
 
         except Exception as e:
-            application.show_message('GM LIST:' + e)
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('GM LIST:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
 
         return '???'
 
@@ -184,15 +199,8 @@ class MIDIUnit_class:
                 print(self.midi_in_settings)
 
         except Exception as e:
-            application.show_message('ERROR:' + str(e))
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('ERROR:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
 
     # Save MIDI settings
     def save_midi_settings(self, num=None):
@@ -208,15 +216,8 @@ class MIDIUnit_class:
                 self.get_midiset_list(num)
         
         except Exception as e:
-            application.show_message('ERROR:' + str(e))
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('ERROR:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
 
     # MIDI-IN via USB-MIDI
     def midi_in(self):
@@ -434,6 +435,71 @@ class MIDIUnit_class:
 ################# End of Unit-MIDI Class Definition #################
 
 
+#################
+### LED class
+#################
+# LED on board blinking without blocking
+#   A blink pattern is a list of step durations (ms), the LED toggles at every step
+#   starting from the state given. do_task() advances the pattern.
+class LED_class:
+    def __init__(self, pin):
+        self._led = digitalio.DigitalInOut(pin)
+        self._led.direction = digitalio.Direction.OUTPUT
+        self._led.value = True
+        self._value = True
+        self._pattern = None
+        self._first = True
+        self._count = 0
+        self._step = 0
+        self._step_ms = 0
+
+    # Set/Get the LED state shown while no pattern is playing
+    def value(self, flg=None):
+        if flg is None:
+            return self._value
+
+        self._value = flg
+        if self._pattern is None and self._led.value != flg:
+            self._led.value = flg
+
+    # Play a blink pattern count times (replaces the pattern playing)
+    #   first    : LED state of the first step
+    #   durations: duration (ms) of each step
+    def blink(self, first, durations, count=1):
+        self._pattern = durations
+        self._first = first
+        self._count = count
+        self._step = 0
+        self._step_ms = supervisor.ticks_ms()
+        self._led.value = first
+
+    def is_blinking(self):
+        return self._pattern is not None
+
+    # Advance the blink pattern
+    def do_task(self):
+        if self._pattern is None:
+            return
+
+        now = supervisor.ticks_ms()
+        if ticks_diff(now, self._step_ms) < self._pattern[self._step]:
+            return
+
+        self._step_ms = now
+        self._step += 1
+        if self._step >= len(self._pattern):
+            self._step = 0
+            self._count -= 1
+            if self._count <= 0:
+                self._pattern = None
+                self._led.value = self._value
+                return
+
+        self._led.value = self._first if self._step % 2 == 0 else not self._first
+
+################# End of LED Class Definition #################
+
+
 ########################
 ### OLED SSD1306 class
 ########################
@@ -445,6 +511,8 @@ class OLED_SSD1306_class:
         self.address = address
         self._width = width
         self._height = height
+        self._deferred = False
+        self._dirty = False
 
     def init_device(self, device):
         if device is None:
@@ -481,9 +549,25 @@ class OLED_SSD1306_class:
         if self.is_available():
             self._display.text(s, x, y, color, font_name='font5x8.bin', size=disp_size)
 
-    def show(self):
+    # Set/Get deferred refresh mode (show() only marks the frame buffer to be sent by refresh())
+    def defer_show(self, flg=None):
+        if flg is None:
+            return self._deferred
+        
+        self._deferred = flg
+
+    def show(self, force=False):
         if self.is_available():
-            self._display.show()
+            if self._deferred and force == False:
+                self._dirty = True
+            else:
+                self._display.show()
+                self._dirty = False
+
+    # Send the frame buffer to the device if it has been changed since the last refresh
+    def refresh(self):
+        if self._dirty:
+            self.show(True)
 
     def clear(self, color=0, refresh=True):
         self.fill(color)
@@ -528,10 +612,50 @@ class Application_class:
             [self.COMMAND_MODE_REVERB_PROGRAM, self.COMMAND_MODE_REVERB_LEVEL, self.COMMAND_MODE_REVERB_FEEDBACK]
         ]
 
+        # Message queue (error messages are shown by do_task() without blocking)
+        self.MESSAGE_HOLD_MS = 3000
+        self.MESSAGE_REPEAT_MS = 10000
+        self.MESSAGE_QUEUE_SIZE = 4
+        self._messages = []
+        self._message_ms = None
+        self._message_last = None
+        self._message_last_ms = 0
+
     def show_message(self, msg, x=0, y=0, color=1):
         self._display.text(msg, x, y, color)
         self._display.show()
 
+    # Queue a message to show for MESSAGE_HOLD_MS
+    #   A message already queued, or shown within MESSAGE_REPEAT_MS, is not queued again.
+    def queue_message(self, msg):
+        if msg in self._messages or len(self._messages) >= self.MESSAGE_QUEUE_SIZE:
+            return
+
+        if msg == self._message_last and ticks_diff(supervisor.ticks_ms(), self._message_last_ms) < self.MESSAGE_REPEAT_MS:
+            return
+
+        self._messages.append(msg)
+
+    # Show the messages queued one by one
+    def do_task(self):
+        now = supervisor.ticks_ms()
+        if self._message_ms is not None:
+            if ticks_diff(now, self._message_ms) < self.MESSAGE_HOLD_MS:
+                return
+
+            self._message_ms = None
+            self._message_last_ms = now
+            self._display.clear()
+            self.show_midi_channel(True, True)
+
+        if len(self._messages) > 0:
+            msg = self._messages.pop(0)
+            self.show_midi_channel(False, True)
+            self.show_message(msg)
+            self._message_ms = now
+            self._message_last = msg
+            self._message_last_ms = now
+
     def channel(self, ch=None):
         if ch is not None:
             self._channel = ch % 16
@@ -685,6 +809,15 @@ class CARDKB_class:
         self.available = False
         self.command = ''
 
+        # Keyboard polling interval (ms), the keyboard task is scheduled on this
+        self.POLL_MS = 10
+        self._poll_ms = self.POLL_MS
+
+        # I2C buffers reused in every poll
+        self._kb_request = bytes([1])
+        self._kb_value = bytearray(1)
+        self.reset_statistics()
+
         self.i2c = i2c
         if self.i2c is None:
             return
@@ -693,27 +826,72 @@ class CARDKB_class:
         while not self.i2c.try_lock():
             pass
 
-        for i in self.i2c.scan():
-            print('addr 0x{0:x}'.format(i))
-            if i == self.CARDKB_ADDRESS:
-                self.available = True
-                break
+        try:
+            for i in self.i2c.scan():
+                print('addr 0x{0:x}'.format(i))
+                if i == self.CARDKB_ADDRESS:
+                    self.available = True
+                    break
+
+        finally:
+            self.i2c.unlock()
 
         print("\n")
 
     def is_available(self):
         return self.available
 
-    # Read a key value
+    # Set/Get the keyboard polling interval (ms)
+    def poll_interval(self, ms=None):
+        if ms is None:
+            return self._poll_ms
+
+        self._poll_ms = max(1, ms)
+        if scheduler is not None:
+            task = scheduler.task('KEYBOARD')
+            if task is not None:
+                task.period_ms = self._poll_ms
+
+    # Keyboard I/O statistics
+    def reset_statistics(self):
+        self.io_reads = 0
+        self.io_busy = 0
+        self.io_total_us = 0
+        self.io_max_us = 0
+        self._io_t0 = monotonic_ns()
+
+    # Print how much time the keyboard I/O takes
+    def print_statistics(self):
+        elapsed_us = (monotonic_ns() - self._io_t0) // 1000
+        print('KBD I/O: reads={} busy={} avg={}us max={}us load={}.{:02d}%'.format(
+            self.io_reads, self.io_busy,
+            self.io_total_us // self.io_reads if self.io_reads > 0 else 0, self.io_max_us,
+            self.io_total_us * 100 // elapsed_us if elapsed_us > 0 else 0,
+            self.io_total_us * 10000 // elapsed_us % 100 if elapsed_us > 0 else 0))
+
+    # Read a key value (None if no key is pressed or the I2C bus is busy)
+    #   The value returned is a buffer reused in the next read.
     def read_key(self):
         if self.available:
-            while self.i2c.try_lock():
-                pass
-
-            kb_value = bytearray(1)
-            self.i2c.writeto_then_readfrom(self.CARDKB_ADDRESS, bytes([1]), kb_value)
-            if kb_value[0] != 0x00:
-                return kb_value
+            if not self.i2c.try_lock():
+                self.io_busy += 1
+                return None
+
+            t0 = monotonic_ns()
+            try:
+                self.i2c.writeto_then_readfrom(self.CARDKB_ADDRESS, self._kb_request, self._kb_value)
+
+            finally:
+                self.i2c.unlock()
+                io_us = (monotonic_ns() - t0) // 1000
+                self.io_reads += 1
+                self.io_total_us += io_us
+                if io_us > self.io_max_us:
+                    self.io_max_us = io_us
+
+            # 0x00 means no key has been pressed since the last read
+            if self._kb_value[0] != 0x00:
+                return self._kb_value
 
         return None
 
@@ -818,15 +996,10 @@ class CARDKB_class:
             # Test sound
             elif key_code == 0x20 or key_code == 0xAF:
                 print('PROGRAM/VOLUME: ', synth.midi_get_instrument(0), synth.midi_master_volume())
-                synth.set_note_on(application.channel(), 60, 127)
-                sleep(0.5)
-                synth.set_note_on(application.channel(), 64, 127)
-                sleep(0.5)
-                synth.set_note_on(application.channel(), 67, 127)
-                sleep(0.5)
-                synth.set_note_off(application.channel(), 60)
-                synth.set_note_off(application.channel(), 64)
-                synth.set_note_off(application.channel(), 67)
+                channel = application.channel()
+                for i, note_key in enumerate((60, 64, 67)):
+                    sequencer.schedule(i * 500, bytes([0x90 + channel, note_key, 127]))
+                    sequencer.schedule(1500, bytes([0x90 + channel, note_key, 0]))
 
             # Command interpriter
             else:
@@ -931,16 +1104,232 @@ class CARDKB_class:
 ################# End of CARD.KB Class Definition #################
     
 
+#####################
+### Sequencer class
+#####################
+# Timed MIDI event scheduler
+#   Events (due time, message) are kept in a binary heap ordered by the due time
+#   (time.monotonic_ns), events due at the same time are sent in order of scheduling.
+#   do_task() sends the events due without blocking.
+class Sequencer_class:
+    # Constructor
+    #   send: function sending a MIDI message
+    def __init__(self, send):
+        self._send = send
+        self._heap = []			# [due_ns, sequence number, message]
+        self._sequence = 0
+
+    # Number of the events waiting
+    def pending(self):
+        return len(self._heap)
+
+    def is_empty(self):
+        return len(self._heap) == 0
+
+    # Schedule a message to send at due_ns (time.monotonic_ns)
+    def schedule_at(self, due_ns, midi_msg):
+        heap = self._heap
+        heap.append([due_ns, self._sequence, midi_msg])
+        self._sequence += 1
+
+        # Sift up
+        pos = len(heap) - 1
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not self._earlier(heap[pos], heap[parent]):
+                break
+
+            heap[pos], heap[parent] = heap[parent], heap[pos]
+            pos = parent
+
+    # Schedule a message to send delay_ms later
+    def schedule(self, delay_ms, midi_msg):
+        self.schedule_at(monotonic_ns() + int(delay_ms * 1000000), midi_msg)
+
+    # Discard all the events waiting
+    def clear(self):
+        self._heap = []
+
+    # Event e1 is earlier than e2 or not
+    def _earlier(self, e1, e2):
+        return e1[0] < e2[0] or (e1[0] == e2[0] and e1[1] < e2[1])
+
+    # Remove the earliest event
+    def _pop(self):
+        heap = self._heap
+        last = heap.pop()
+        if len(heap) == 0:
+            return
+
+        heap[0] = last
+
+        # Sift down
+        size = len(heap)
+        pos = 0
+        while True:
+            child = pos * 2 + 1
+            if child >= size:
+                break
+
+            if child + 1 < size and self._earlier(heap[child + 1], heap[child]):
+                child += 1
+
+            if not self._earlier(heap[child], heap[pos]):
+                break
+
+            heap[pos], heap[child] = heap[child], heap[pos]
+            pos = child
+
+    # Send the events due
+    def do_task(self):
+        if len(self._heap) == 0:
+            return
+
+        now = monotonic_ns()
+        heap = self._heap
+        while len(heap) > 0 and heap[0][0] <= now:
+            midi_msg = heap[0][2]
+            self._pop()
+            self._send(midi_msg)
+
+################# End of Sequencer Class Definition #################
+
+
+#####################
+### Scheduler class
+#####################
+# A task called every period_ms by the scheduler
+class Task_class:
+    def __init__(self, name, func, period_ms, priority):
+        self.name = name
+        self.func = func
+        self.period_ms = period_ms
+        self.priority = priority
+        self.last_ms = supervisor.ticks_ms()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.runs = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.max_late_ms = 0
+
+    # Due to run at now (ticks_ms)
+    def is_due(self, now):
+        return ticks_diff(now, self.last_ms) >= self.period_ms
+
+    # Average run time in micro seconds
+    def average_us(self):
+        if self.runs == 0:
+            return 0
+
+        return self.total_us // self.runs
+
+
+# Cooperative scheduler on asyncio
+#   Each task runs as an asyncio task every period_ms (0 means every pass).
+#   A task steps aside while a periodic task with higher priority is due, so tasks
+#   due at the same time run in order of priority. Tasks running every pass
+#   never hold the others back.
+#   Run time (us) and lateness (ms) are measured for each task.
+class Scheduler_class:
+    def __init__(self):
+        self._tasks = []
+        self._error_handler = None
+
+    # Add a task, larger priority runs first
+    def add_task(self, name, func, period_ms, priority=0):
+        task = Task_class(name, func, period_ms, priority)
+        self._tasks.append(task)
+        return task
+
+    # Get a task by name
+    def task(self, name):
+        for task in self._tasks:
+            if task.name == name:
+                return task
+
+        return None
+
+    def tasks(self):
+        return self._tasks
+
+    # Set/Get the error handler called with an exception raised in a task
+    def error_handler(self, func=None):
+        if func is None:
+            return self._error_handler
+
+        self._error_handler = func
+
+    # Is a periodic task with higher priority than the priority due at now
+    def _higher_due(self, priority, now):
+        for task in self._tasks:
+            if task.priority > priority and task.period_ms > 0 and task.is_due(now):
+                return True
+
+        return False
+
+    async def _run_task(self, task):
+        while True:
+            now = supervisor.ticks_ms()
+            wait_ms = task.period_ms - ticks_diff(now, task.last_ms)
+            if wait_ms > 0:
+                await asyncio.sleep(wait_ms / 1000)
+                continue
+
+            if self._higher_due(task.priority, now):
+                await asyncio.sleep(0)
+                continue
+
+            # Lateness from the time due
+            if task.period_ms > 0 and -wait_ms > task.max_late_ms:
+                task.max_late_ms = -wait_ms
+
+            task.last_ms = now
+            t0 = monotonic_ns()
+            try:
+                task.func()
+
+            except Exception as e:
+                if self._error_handler is None:
+                    raise
+
+                self._error_handler(e)
+
+            run_us = (monotonic_ns() - t0) // 1000
+            task.runs += 1
+            task.total_us += run_us
+            if run_us > task.max_us:
+                task.max_us = run_us
+
+            await asyncio.sleep(0)
+
+    # Run all tasks (never returns)
+    async def run(self):
+        await asyncio.gather(*[asyncio.create_task(self._run_task(task)) for task in self._tasks])
+
+    def reset_statistics(self):
+        for task in self._tasks:
+            task.reset_statistics()
+
+    # Print timing of the tasks
+    def print_statistics(self):
+        print('TASK     PERIOD PRI   RUNS  AVGus  MAXus LATEms')
+        for task in self._tasks:
+            print('{:8s} {:6d} {:3d} {:6d} {:6d} {:6d} {:6d}'.format(task.name, task.period_ms, task.priority, task.runs, task.average_us(), task.max_us, task.max_late_ms))
+
+################# End of Scheduler Class Definition #################
+
+
 def setup():
-    global pico_led, synth, display, cardkb, view, application
+    global pico_led, synth, display, cardkb, view, application, sequencer
 
     # LED on board
-    pico_led = digitalio.DigitalInOut(GP25)
-    pico_led.direction = digitalio.Direction.OUTPUT
-    pico_led.value = True
+    pico_led = LED_class(GP25)
 
     # Unit Synthesizer
     synth = MIDIUnit_class(0, (GP0, GP1))
+    sequencer = Sequencer_class(synth.midi_out)
     synth.midi_master_volume(127)
     synth.midi_instrument()
     synth.midi_effectors()
@@ -960,13 +1349,8 @@ def setup():
         
     except:
         display = OLED_SSD1306_class(None)
-        pico_led.value = False
         print('ERROR I2C1')
-        for cnt in list(range(10)):
-            pico_led.value = False
-            sleep(0.5)
-            pico_led.value = True
-            sleep(1.0)
+        pico_led.blink(False, (500, 1000), 10)
 
     print('Start application.')
     application = Application_class(display)
@@ -978,13 +1362,8 @@ def setup():
         cardkb = CARDKB_class(i2c0)
         if cardkb.is_available() == False:
             print('CARD.KB not availalbe.')
-            application.show_midi_channel(False, True)
-            application.show_message('NO KEYBOARD.')
-            for cnt in list(range(10)):
-                pico_led.value = True
-                sleep(1.0)
-                pico_led.value = False
-                sleep(0.5)
+            application.queue_message('NO KEYBOARD.')
+            pico_led.blink(True, (1000, 500), 10)
 
         else:
             print('Keyboard ready.')
@@ -997,17 +1376,58 @@ def setup():
     except:
         cardkb = CARDKB_class(None)
         print('ERROR I2C0')
-        application.show_midi_channel(False, True)
-        application.show_message('ERROR I2C0')
-        for cnt in list(range(10)):
-            pico_led.value = True
-            sleep(1.0)
-            pico_led.value = False
-            sleep(0.5)
+        application.queue_message('ERROR I2C0')
+        pico_led.blink(True, (1000, 500), 10)
 
     application.show_midi_channel(True, True)
 
 
+# Show an exception raised in a task
+def task_error(e):
+    print('CATCH EXCEPTION:', e)
+    application.queue_message('ERROR: ' + str(e))
+    pico_led.blink(False, (500, 1000), 10)
+
+
+# MIDI pump task
+def midi_task():
+    synth.do_task()
+
+    # Generated notes due
+    sequencer.do_task()
+
+
+# CARD.KB task (polls the keyboard once per slot)
+def keyboard_task():
+    cardkb.do_task()
+
+
+# Display refresh task (shows the messages queued)
+def display_task():
+    application.do_task()
+    display.refresh()
+
+
+# LED blink task
+def led_task():
+    pico_led.do_task()
+
+
+async def main():
+    global scheduler
+
+    scheduler = Scheduler_class()
+    scheduler.error_handler(task_error)
+    scheduler.add_task('MIDI', midi_task, 0, 2)
+    scheduler.add_task('KEYBOARD', keyboard_task, cardkb.poll_interval(), 1)
+    scheduler.add_task('DISPLAY', display_task, 50, 0)
+    scheduler.add_task('LED', led_task, 20, 0)
+
+    # The display is refreshed by the display task from here
+    display.defer_show(True)
+    await scheduler.run()
+
+
 ######### MAIN ##########
 if __name__=='__main__':
     # Setup
@@ -1016,25 +1436,8 @@ if __name__=='__main__':
     display = None
     cardkb = None
     application = None
+    scheduler = None
+    sequencer = None
     setup()
 
-    while True:
-        try:
-            # CARD.KB task
-            cardkb.do_task()
-            
-            # Unit SYNTH task
-            synth.do_task()
-
-        except Exception as e:
-            print('CATCH EXCEPTION:', e)
-            application.show_midi_channel(False, True)
-            application.show_message('ERROR: ' + str(e))
-            for cnt in list(range(10)):
-                pico_led.value = False
-                sleep(0.5)
-                pico_led.value = True
-                sleep(1.0)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+    asyncio.run(main())
@@ -37,6 +37,13 @@
 #            Non-blocking MIDI data receieve in USB MIDI HOST mode.
 #     1.1.1: 04/03/2025
 #            Type any key to work as a USB device in start-up process.
+#
+# LIBRARIES: copy to /lib in the CIRCUITPY drive
+#   In this repository: adafruit_midi, adafruit_usb_host_midi,
+#                       adafruit_ssd1306, adafruit_framebuf
+#   From the Adafruit CircuitPython Library Bundle (9.x):
+#     asyncio       : for the scheduled tasks (not built in CircuitPython)
+#     adafruit_ticks: required by asyncio
 #########################################################################
 # COMMANDS for SYNTHESIZER PARAMETER SETTING DISPLAY:
 #  CH/ch: change MIDI channel to edit
@@ -58,11 +65,21 @@
 #  M /m : MIDI-IN selector (USB or UART1)
 #  UA/ua: UART0 MIDI-OUT selector (OUT or OFF)
 #  UT/ut: UART1 MIDI-OUT selector (OUT or OFF)
+#  RS/rs: routing source to edit (USB host, USB device or UART1 MIDI-IN)
+#  RC/rc: routing channel to edit
+#  RD/rd: routing destinations of the source and channel (UART0, UART1, USB device MIDI-OUT)
+#  VC/vc: velocity curve of the channel (LINear, SOFt, HaRD, FIXed or CuSTom)
+#  VP/vp: point of the custom velocity curve to edit (input velocity 0, 32, 64, 96, 127)
+#  VV/vv: fixed velocity, or output velocity of the custom curve point
+# COMMANDS for MIDI MONITOR DISPLAY:
+#  M /m : MIDI-IN to MIDI-OUT instrumentation on/off
+#  C /c : clear the instrumentation
+#  D /d : dump the instrumentation and task timings to the serial console
 # COMMANDS common
 #  SPACE: Play a test melody
 #  fn+SP: Resed synthesizer and effctor settings and play test
 #  ESC  : switch ignore MIDI-IN mode
-#  TAB  : change the display mode
+#  TAB  : change the display mode (synthesizer, configuration, MIDI monitor)
 #
 # VALUE CONTROLES:
 #     [LEFT ]: decrement value - 1
@@ -81,12 +98,14 @@ from board import *
 import digitalio
 from busio import UART			# for UART MIDI
 from busio import I2C			# for I2C
-from time import sleep
+from time import sleep, monotonic_ns
 import os, re
 import json
+import asyncio					# from the Library Bundle, needs adafruit_ticks
 
 import usb_midi					# for USB MIDI
 import adafruit_midi
+from adafruit_midi.midi_message import MIDIMessage, MessagePool
 from adafruit_midi.control_change import ControlChange
 from adafruit_midi.note_off import NoteOff
 from adafruit_midi.note_on import NoteOn
@@ -186,6 +205,522 @@ class sdcard_class:
 ################# End of SD Card Class Definition #################
 
 
+#################
+### Time helpers
+#################
+# supervisor.ticks_ms() wraps around at 2**29 milliseconds
+TICKS_PERIOD = 1 << 29
+TICKS_MAX = TICKS_PERIOD - 1
+TICKS_HALFPERIOD = TICKS_PERIOD // 2
+
+# Milliseconds from t0 to t1 (negative if t1 is before t0)
+def ticks_diff(t1, t0):
+    diff = (t1 - t0) & TICKS_MAX
+    return ((diff + TICKS_HALFPERIOD) & TICKS_MAX) - TICKS_HALFPERIOD
+
+
+#########################
+### MIDI-OUT queue class
+#########################
+class MIDIQueue_class:
+    # Constructor
+    #   size: queue buffer size in bytes
+    # Each entry is [LENGTH, TIME LSB, TIME MSB, MIDI BYTES...],
+    # TIME is the lower 16 bits of supervisor.ticks_ms() when the entry was queued.
+    def __init__(self, size):
+        self._buf = bytearray(size)
+        self._size = size
+        self._read = 0
+        self._write = 0
+        self.entries = 0
+
+    def is_empty(self):
+        return self._read == self._write
+
+    # Queue midi_msg[0:num], returns False if there is no space
+    def put(self, midi_msg, num, now):
+        if self._write + num + 3 > self._size:
+            self._compact()
+            if self._write + num + 3 > self._size:
+                return False
+
+        buf = self._buf
+        w = self._write
+        buf[w] = num
+        buf[w + 1] = now & 0xFF
+        buf[w + 2] = (now >> 8) & 0xFF
+        w += 3
+        for i in range(num):
+            buf[w] = midi_msg[i]
+            w += 1
+
+        self._write = w
+        self.entries += 1
+        return True
+
+    # Length of the first entry
+    def head_length(self):
+        return self._buf[self._read]
+
+    # Queued time of the first entry
+    def head_time(self):
+        return self._buf[self._read + 1] | (self._buf[self._read + 2] << 8)
+
+    # A MIDI byte of the first entry
+    def head_byte(self, idx):
+        return self._buf[self._read + 3 + idx]
+
+    # Remove the first entry
+    def pop(self):
+        self._read += self._buf[self._read] + 3
+        self.entries -= 1
+        if self._read == self._write:
+            self._read = 0
+            self._write = 0
+
+    # Move the entries to the front of the buffer
+    def _compact(self):
+        r = self._read
+        if r == 0:
+            return
+
+        buf = self._buf
+        num = self._write - r
+        for i in range(num):
+            buf[i] = buf[r + i]
+
+        self._read = 0
+        self._write = num
+
+################# End of MIDI-OUT Queue Class Definition #################
+
+
+##########################
+### UART MIDI-OUT class
+##########################
+class MIDIOut_class:
+    # Constructor
+    #   uart: UART object to send MIDI messages
+    # MIDI bytes written are split into messages and queued by priority:
+    #   notes, then controllers, program changes and pitch bends, then SysEx.
+    # pump() sends them at the UART speed without blocking, whole messages only.
+    # System Real-Time messages are sent immediately.
+    def __init__(self, uart):
+        self.OUT_BUF_SIZE = 256
+        self.RUNNING_STATUS_REFRESH_MS = 1000	# Send a full status byte at least once in this period
+        self.BYTE_US = 320						# Wire time of a byte (10 bits at 31250 baud)
+        self.FIFO_BYTES = 32					# UART transmit FIFO, writing up to this does not block
+        self.SYSEX_CHUNK = 16					# SysEx is queued in chunks of this size
+
+        self._uart = uart
+        self._out_buf = bytearray(self.OUT_BUF_SIZE)
+        self._out_view = memoryview(self._out_buf)
+        self._realtime_buf = bytearray(1)
+
+        # Priority queues
+        self.PRIORITY_NOTE    = 0
+        self.PRIORITY_CONTROL = 1
+        self.PRIORITY_SYSEX   = 2
+        self._queues = (MIDIQueue_class(256), MIDIQueue_class(1536), MIDIQueue_class(768))
+        self._control_pending = [0] * 16		# Entries of each channel in the control queue
+        self._sysex_open = False				# SysEx started on the wire but not ended yet
+
+        # Message parser of write()
+        self._msg = bytearray(self.SYSEX_CHUNK)
+        self._msg_len = 0
+        self._msg_need = 0
+        self._in_status = 0						# Running status of the bytes written
+        self._in_sysex = False
+
+        # Local messages held while a message forwarded is open
+        self.HOLD_SIZE = 256
+        self._hold = bytearray(self.HOLD_SIZE)
+        self._hold_view = memoryview(self._hold)
+        self._hold_len = 0
+        
+        # Wire time estimation
+        self._backlog_us = 0					# Wire time of the bytes in the UART
+        self._pump_ms = supervisor.ticks_ms()
+
+        # Running status: a channel message status byte is not sent
+        # if it is same as the previous one sent.
+        self._running_status = True
+        self._status = 0					# Status byte the receiver is running on (0: none)
+        self._refresh_ms = supervisor.ticks_ms()
+
+        # Statistics
+        self.bytes_in  = 0					# Bytes given to write()
+        self.bytes_out = 0					# Bytes written to the UART
+        self.writes    = 0					# Number of UART writes
+        self.max_depth = 0					# Maximum number of messages queued
+        self.max_latency_ms = 0				# Maximum time a message waited in the queues
+        self.overflows = 0					# Times the queues were full and sent with blocking
+        self.dropped   = 0					# Messages lost in the queues full
+
+        # Instrumentation (MIDIMonitor_class), the time messages written arrived at MIDI-IN
+        self.monitor = None
+        self.stamp_ms = None
+
+    # Set/Get running status mode
+    def running_status(self, flg=None):
+        if flg is not None:
+            self._running_status = flg
+            self._status = 0
+            
+        return self._running_status
+
+    # Forget the running status, the next channel message is sent with its status byte
+    def reset_running_status(self):
+        self._status = 0
+
+    # Bytes not sent thanks to the running status
+    def bytes_saved(self):
+        return self.bytes_in - self.bytes_out
+
+    # Number of messages queued
+    def queue_depth(self):
+        return self._queues[0].entries + self._queues[1].entries + self._queues[2].entries
+
+    # Nothing to send
+    def is_idle(self):
+        return self._queues[0].is_empty() and self._queues[1].is_empty() and self._queues[2].is_empty()
+
+    # Write whole MIDI messages generated locally to the queues
+    #   While a message forwarded by write_stream() is open (SysEx or a part of a message),
+    #   they are held and written when it ends, so they never break into it.
+    def write(self, midi_msg):
+        if self._in_sysex or self._msg_len > 0:
+            num = len(midi_msg)
+            if self._hold_len + num <= self.HOLD_SIZE:
+                self._hold[self._hold_len:self._hold_len + num] = midi_msg
+                self._hold_len += num
+                return
+
+            # No more room to hold, end the message forwarded
+            self.end_stream()
+
+        # Running status of the stream is not changed by the local messages
+        in_status = self._in_status
+        self._parse(midi_msg)
+        self._in_status = in_status
+
+    # Write MIDI bytes forwarded (any number of messages or a part of a message) to the queues
+    def write_stream(self, midi_msg):
+        self._parse(midi_msg)
+        if self._hold_len > 0 and not self._in_sysex and self._msg_len == 0:
+            self._release()
+
+    # End the message forwarded (a SysEx open gets F7, a part of a message is dropped)
+    # and write the messages held.
+    def end_stream(self):
+        if self._in_sysex:
+            self._in_sysex = False
+            self._msg[self._msg_len] = 0xF7
+            self._queue(self.PRIORITY_SYSEX, self._msg_len + 1)
+
+        self._msg_len = 0
+        self._in_status = 0
+        self._release()
+
+    # Write the local messages held
+    def _release(self):
+        num = self._hold_len
+        if num == 0:
+            return
+
+        self._hold_len = 0
+        in_status = self._in_status
+        self._parse(self._hold_view[:num])
+        self._in_status = in_status
+
+    # Parse MIDI bytes into messages and queue them
+    def _parse(self, midi_msg):
+        msg = self._msg
+        for b in midi_msg:
+            # System Real-Time
+            if b >= 0xF8:
+                self._realtime_buf[0] = b
+                self._uart.write(self._realtime_buf)
+                self._backlog_us += self.BYTE_US
+                self.bytes_out += 1
+                self.writes += 1
+                self._status = 0
+
+            # Status byte
+            elif b >= 0x80:
+                if self._in_sysex:
+                    self._in_sysex = False
+                    msg[self._msg_len] = 0xF7
+                    self._queue(self.PRIORITY_SYSEX, self._msg_len + 1)
+                    self._msg_len = 0
+                    if b == 0xF7:
+                        continue
+
+                # Channel message
+                if b < 0xF0:
+                    self._in_status = b
+                    msg[0] = b
+                    self._msg_len = 1
+                    self._msg_need = 2 if b < 0xC0 or b >= 0xE0 else 1
+
+                # SysEx
+                elif b == 0xF0:
+                    self._in_status = 0
+                    self._in_sysex = True
+                    msg[0] = b
+                    self._msg_len = 1
+
+                # System Common (F7 without SysEx is ignored)
+                elif b != 0xF7:
+                    self._in_status = 0
+                    msg[0] = b
+                    self._msg_len = 1
+                    self._msg_need = 2 if b == 0xF2 else (1 if b == 0xF1 or b == 0xF3 else 0)
+                    if self._msg_need == 0:
+                        self._queue(self.PRIORITY_SYSEX, 1)
+                        self._msg_len = 0
+
+            # SysEx data
+            elif self._in_sysex:
+                msg[self._msg_len] = b
+                self._msg_len += 1
+                if self._msg_len == self.SYSEX_CHUNK - 1:
+                    self._queue(self.PRIORITY_SYSEX, self._msg_len)
+                    self._msg_len = 0
+
+            # Message data (with running status)
+            elif self._msg_len > 0 or self._in_status != 0:
+                if self._msg_len == 0:
+                    msg[0] = self._in_status
+                    self._msg_len = 1
+
+                msg[self._msg_len] = b
+                self._msg_len += 1
+                if self._msg_len > self._msg_need:
+                    if msg[0] >= 0xF0:
+                        self._queue(self.PRIORITY_SYSEX, self._msg_len)
+                    elif msg[0] < 0xA0 and self._control_pending[msg[0] & 0x0F] == 0:
+                        self._queue(self.PRIORITY_NOTE, self._msg_len)
+                    else:
+                        # Notes never overtake the controllers queued before on the same channel
+                        self._control_pending[msg[0] & 0x0F] += 1
+                        self._queue(self.PRIORITY_CONTROL, self._msg_len)
+
+                    self._msg_len = 0
+
+        # A part of SysEx is sent as soon as possible
+        if self._in_sysex and self._msg_len > 0:
+            self._queue(self.PRIORITY_SYSEX, self._msg_len)
+            self._msg_len = 0
+
+        self.bytes_in += len(midi_msg)
+
+    # Queue the message parsed
+    def _queue(self, priority, num):
+        now = supervisor.ticks_ms() if self.stamp_ms is None else self.stamp_ms
+        while not self._queues[priority].put(self._msg, num, now):
+            # Queues are full, send them even if the UART blocks
+            self.overflows += 1
+            if self.pump(True) == 0:
+                self.dropped += 1
+                if self.monitor is not None and self.monitor.enabled():
+                    self.monitor.dropped += 1
+                return
+
+        depth = self.queue_depth()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    # Queue to send next
+    def _next_queue(self):
+        # Nothing but the SysEx can be sent until it ends
+        if self._sysex_open:
+            return None if self._queues[self.PRIORITY_SYSEX].is_empty() else self._queues[self.PRIORITY_SYSEX]
+
+        for queue in self._queues:
+            if not queue.is_empty():
+                return queue
+
+        return None
+
+    # Send messages queued as far as the UART can take without blocking
+    #   force: send all the messages even if the UART blocks
+    def pump(self, force=False):
+        now = supervisor.ticks_ms()
+        self._backlog_us -= ticks_diff(now, self._pump_ms) * 1000
+        if self._backlog_us < 0:
+            self._backlog_us = 0
+        self._pump_ms = now
+
+        if self._running_status and ticks_diff(now, self._refresh_ms) >= self.RUNNING_STATUS_REFRESH_MS:
+            self._status = 0
+            self._refresh_ms = now
+
+        budget = self.OUT_BUF_SIZE if force else self.FIFO_BYTES - (self._backlog_us + self.BYTE_US - 1) // self.BYTE_US
+        buf = self._out_buf
+        num = 0
+        status = self._status
+        monitor = self.monitor if self.monitor is not None and self.monitor.enabled() else None
+        queue = self._next_queue()
+        while queue is not None:
+            length = queue.head_length()
+            if num + length > budget:
+                if force and num > 0:
+                    self._send(num)
+                    num = 0
+                    continue
+                break
+
+            # Copy the message with the running status
+            for i in range(length):
+                b = queue.head_byte(i)
+                if b >= 0x80:
+                    if b >= 0xF0:
+                        status = 0
+                        if b == 0xF0:
+                            self._sysex_open = True
+                    elif b == status:
+                        continue
+                    elif self._running_status:
+                        status = b
+
+                buf[num] = b
+                num += 1
+
+            if queue.head_byte(length - 1) == 0xF7:
+                self._sysex_open = False
+
+            latency = (now - queue.head_time()) & 0xFFFF
+            if latency > self.max_latency_ms:
+                self.max_latency_ms = latency
+
+            if monitor is not None:
+                monitor.latency(latency)
+
+            if queue is self._queues[self.PRIORITY_CONTROL]:
+                self._control_pending[queue.head_byte(0) & 0x0F] -= 1
+
+            queue.pop()
+            queue = self._next_queue()
+
+        self._status = status
+        if num > 0:
+            self._send(num)
+
+        return num
+
+    # Write the bytes in the output buffer to the UART
+    def _send(self, num):
+        self._uart.write(self._out_view[:num])
+        self._backlog_us += num * self.BYTE_US
+        self.bytes_out += num
+        self.writes += 1
+
+################# End of UART MIDI-OUT Class Definition #################
+
+
+#########################
+### MIDI monitor class
+#########################
+# Instrumentation of the MIDI-IN to MIDI-OUT path (off until enabled)
+#   latency   : histogram of the time (ms) from USB MIDI-IN to the UART write
+#   loop      : period (us) of MIDIUnit_class.do_task()
+#   processing: time (us) from MIDI-IN to the end of dispatching the messages received
+#   msgs_in   : USB MIDI-IN messages, msgs_out: messages written to the UARTs
+#   dropped   : messages lost in full MIDI-OUT queues, skipped: controllers thinned out
+class MIDIMonitor_class:
+    def __init__(self):
+        self.LATENCY_EDGES_MS = (1, 2, 4, 8, 16, 32, 64)	# Lower edges of the buckets but the first one
+        self._enabled = False
+        self.reset()
+
+    # Set/Get instrumentation on/off
+    def enabled(self, flg=None):
+        if flg is not None:
+            self._enabled = flg
+            self._loop_ns = None
+
+        return self._enabled
+
+    def reset(self):
+        self.histogram = [0] * (len(self.LATENCY_EDGES_MS) + 1)
+        self.latency_total_ms = 0
+        self.latency_max_ms = 0
+        self.msgs_in = 0
+        self.msgs_out = 0
+        self.dropped = 0
+        self.skipped = 0
+        self.loops = 0
+        self.loop_total_us = 0
+        self.loop_max_us = 0
+        self.process_count = 0
+        self.process_total_us = 0
+        self.process_max_us = 0
+        self._loop_ns = None
+
+    # A message written to the UART latency_ms after MIDI-IN
+    def latency(self, latency_ms):
+        bucket = 0
+        for edge in self.LATENCY_EDGES_MS:
+            if latency_ms < edge:
+                break
+            bucket += 1
+
+        self.histogram[bucket] += 1
+        self.latency_total_ms += latency_ms
+        if latency_ms > self.latency_max_ms:
+            self.latency_max_ms = latency_ms
+
+        self.msgs_out += 1
+
+    # A pass of the MIDI loop at now_ns (time.monotonic_ns)
+    def loop(self, now_ns):
+        if self._loop_ns is not None:
+            period_us = (now_ns - self._loop_ns) // 1000
+            self.loops += 1
+            self.loop_total_us += period_us
+            if period_us > self.loop_max_us:
+                self.loop_max_us = period_us
+
+        self._loop_ns = now_ns
+
+    # Messages received at arrival_ns have been dispatched
+    def processed(self, arrival_ns, num):
+        process_us = (monotonic_ns() - arrival_ns) // 1000
+        self.msgs_in += num
+        self.process_count += 1
+        self.process_total_us += process_us
+        if process_us > self.process_max_us:
+            self.process_max_us = process_us
+
+    def loop_average_us(self):
+        return self.loop_total_us // self.loops if self.loops > 0 else 0
+
+    def process_average_us(self):
+        return self.process_total_us // self.process_count if self.process_count > 0 else 0
+
+    def latency_average_ms(self):
+        return self.latency_total_ms // self.msgs_out if self.msgs_out > 0 else 0
+
+    # Dump to the serial console
+    #   skipped_bytes: bytes skipped by the MIDI-IN parsers
+    def print_statistics(self, skipped_bytes=0):
+        print('MIDI MONITOR:', 'ON' if self._enabled else 'OFF')
+        print('  IN={} OUT={} DROPPED={} SKIPPED={} SKIPPED BYTES={}'.format(self.msgs_in, self.msgs_out, self.dropped, self.skipped, skipped_bytes))
+        print('  LOOP us: avg={} max={} ({} loops)'.format(self.loop_average_us(), self.loop_max_us, self.loops))
+        print('  PROCESS us: avg={} max={}'.format(self.process_average_us(), self.process_max_us))
+        print('  LATENCY ms: avg={} max={}'.format(self.latency_average_ms(), self.latency_max_ms))
+        low = 0
+        for bucket in range(len(self.histogram)):
+            if bucket < len(self.LATENCY_EDGES_MS):
+                print('  {:3d}-{:3d} ms: {}'.format(low, self.LATENCY_EDGES_MS[bucket] - 1, self.histogram[bucket]))
+                low = self.LATENCY_EDGES_MS[bucket]
+            else:
+                print('  {:3d}-    ms: {}'.format(low, self.histogram[bucket]))
+
+################# End of MIDI Monitor Class Definition #################
+
+
 #####################
 ### Unit-MIDI class
 #####################
@@ -195,18 +730,38 @@ class MIDIUnit_class:
     #   port     : A tuple of (Tx, Rx)
     #              This argument is NOT USED, to keep compatibility with M5Stack CORE2.
     def __init__(self, uart_unit=0, port0=(GP0, GP1), port1=(GP4, GP5)):
+        # Reusable MIDI message objects per message type for MIDI-IN
+        self.MIDI_POOL_SIZE = 16
+
         # UART MIDI (MIDI-OUT)
         self._uart0 = UART(tx=port0[0], rx=port0[1], baudrate=31250)
         self._uart1 = None
         if port1 is not None:
             self._uart1 = UART(tx=port1[0], rx=port1[1], baudrate=31250)
+
+        # MIDI-OUT encoders for each UART
+        self._uart0_out = MIDIOut_class(self._uart0)
+        self._uart1_out = None
+        if self._uart1 is not None:
+            self._uart1_out = MIDIOut_class(self._uart1)
+
+        # MIDI-IN to MIDI-OUT instrumentation
+        self._monitor = MIDIMonitor_class()
+        self._arrival_ns = 0
+        self._uart0_out.monitor = self._monitor
+        if self._uart1_out is not None:
+            self._uart1_out.monitor = self._monitor
             
         # USB MIDI device
         print('USB MIDI:', usb_midi.ports)
 #        self._usb_midi = adafruit_midi.MIDI(midi_in=usb_midi.ports[0], in_channel=0, midi_out=usb_midi.ports[1], out_channel=0)
-        self._usb_midi = adafruit_midi.MIDI(midi_in=usb_midi.ports[0], midi_out=usb_midi.ports[1], out_channel=0)
 #        self._usb_midi = adafruit_midi.MIDI(midi_in=usb_midi.ports[0], midi_out=usb_midi.ports[1], out_channel=0)
 #        self._usb_midi = adafruit_midi.MIDI(midi_out=usb_midi.ports[1], out_channel=0)
+        # Message objects received are reused from a pool, a message is valid until the next do_task()
+        # SysEx messages are forwarded in chunks as they arrive, see midi_sysex_out()
+        # System Real-Time messages are forwarded as soon as they are read, see midi_realtime_out()
+        self._realtime_buf = bytearray(1)
+        self._usb_midi = adafruit_midi.MIDI(midi_in=usb_midi.ports[0], midi_out=usb_midi.ports[1], out_channel=0, pool_size=self.MIDI_POOL_SIZE, sysex_handler=self.midi_sysex_out, realtime_handler=self.midi_realtime_out)
 
         # USB MIDI host
         # USB DEVICE   : Vender ID : Product ID
@@ -219,6 +774,135 @@ class MIDIUnit_class:
         self._midi_in_usb    = True			# True: MIDI-IN via USB, False: via UART1
         self._midi_out_uart0 = True			# MIDI-OUT to UART0 or not
         self._midi_out_uart1 = True			# MIDI-OUT to UART1 or not
+
+        # MIDI routing matrix: SOURCE x CHANNEL -> DESTINATIONS (bit mask)
+        # The matrix is in midi_in_settings[channel]['route'][source], and compiled by midi_route_compile()
+        # into a 16 entries table for each source, so a message is routed by one index.
+        self.ROUTE_SOURCE_USB_HOST   = 0
+        self.ROUTE_SOURCE_USB_DEVICE = 1
+        self.ROUTE_SOURCE_UART1      = 2
+        self.ROUTE_SOURCES = 3
+        self.ROUTE_UART0 = 0x01
+        self.ROUTE_UART1 = 0x02
+        self.ROUTE_USB   = 0x04					# USB device MIDI-OUT
+        self.ROUTE_DEFAULT = self.ROUTE_UART0 | self.ROUTE_UART1
+        self._route_tables = [bytearray(16), bytearray(16), bytearray(16)]
+        self._route_system = bytearray(self.ROUTE_SOURCES)	# Routes of system messages from each source (all the channels)
+        self._route_local  = self.ROUTE_DEFAULT	# Routes of the messages made by this program
+        self._route = self._route_local			# Routes of the messages sent by midi_out() now
+        self._route_source = self.ROUTE_SOURCE_USB_HOST
+        self._uart1_route = 0					# Routes of the message being received via UART1
+        self._route_release = bytearray(16)	# Routes to release the notes of each channel (all the routes)
+
+        # Velocity curves: a 128 bytes table for each channel made from the settings by midi_velocity_compile()
+        self.VELOCITY_LINEAR = 0
+        self.VELOCITY_SOFT   = 1
+        self.VELOCITY_HARD   = 2
+        self.VELOCITY_FIXED  = 3
+        self.VELOCITY_CUSTOM = 4
+        self.VELOCITY_CURVES = 5
+        self.VELOCITY_POINTS = [0, 32, 64, 96, 127]		# Input velocities of the custom curve points
+        self.VELOCITY_DEFAULT = [self.VELOCITY_LINEAR, 100, 0, 32, 64, 96, 127]
+        self._velocity_tables = []
+        for ch in range(16):
+            self._velocity_tables.append(bytearray(range(128)))
+
+        # Active notes: 128 bits bitmap for each channel, and number of the notes in each channel
+        self._active_notes = bytearray(16 * 16)
+        self._active_count = bytearray(16)
+        self._usb_midi_out = usb_midi.ports[1]
+        self.flush_ms = 0					# Time to flush MIDI-OUT last time
+        self.settings_flush_ms = 0			# Time to send all the synthesizer settings last time
+        self._settings_t0 = None			# Time the settings were queued, None: sent
+
+        # Preencoded MIDI-OUT messages, the channel and value bytes are patched in place.
+        # midi_out() copies them to the output queues, so they can be reused immediately.
+        self._msg_master_volume  = bytearray([0xF0, 0x7F, 0x7F, 0x04, 0x01, 0, 0, 0xF7])
+        self._msg_instrument     = bytearray([0xC0, 0])
+        self._msg_note           = bytearray([0x90, 0, 0])
+        self._msg_all_notes_off  = bytearray([0xB0, 0x78, 0])
+        self._msg_reverb         = bytearray([0xB0, 0x50, 0, 0xB0, 0x5B, 0])
+        self._msg_chorus         = bytearray([0xB0, 0x51, 0, 0xB0, 0x5D, 0])
+        self._msg_vibrate        = bytearray([0xB0, 0x63, 0x01, 0x62, 0x08, 0x06, 0, 0xB0, 0x63, 0x01, 0x62, 0x09, 0x06, 0, 0xB0, 0x63, 0x01, 0x62, 0x0A, 0x06, 0])
+        self._msg_pitch_bend     = bytearray([0xE0, 0, 0])
+        self._msg_pitch_bend_range = bytearray([0xB0, 0x65, 0x00, 0x64, 0x00, 0x06, 0])
+        self._msg_control_change = bytearray([0xB0, 0, 0])
+        self._msg_nrpn           = bytearray([0xB0, 0x63, 0, 0x62, 0, 0x06, 0])
+        # GS SysEx: F0 41 dev 42 12 addr(3) data checksum F7
+        self._msg_reverb_feedback = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x35, 0, 0, 0xF7])
+        self._msg_chorus_feedback = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x3B, 0, 0, 0xF7])
+        self._msg_chorus_delay    = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x3C, 0, 0, 0xF7])
+        self._msg_modulation      = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x20, 0, 0, 0, 0xF7])
+
+        # Shadow of the settings the synthesizer was sent last for each channel.
+        # midi_instrument() and midi_effectors() send only the parameters changed.
+        self.SHADOW_UNKNOWN = 0xFF				# Not sent yet (or invalidated)
+        self.SHADOW_PROGRAM = 0
+        self.SHADOW_REVERB  = 1					# PROGRAM, LEVEL
+        self.SHADOW_CHORUS  = 3					# PROGRAM, LEVEL
+        self.SHADOW_VIBRATE = 5					# RATE, DEPTH, DELAY
+        self.SHADOW_SIZE    = 8
+        self._shadow = []
+        for ch in range(16):
+            self._shadow.append(bytearray([self.SHADOW_UNKNOWN] * self.SHADOW_SIZE))
+
+        # GS SysEx effector parameters are not of a channel but of the synthesizer
+        self.SHADOW_REVERB_FEEDBACK = 0
+        self.SHADOW_CHORUS_FEEDBACK = 1
+        self.SHADOW_CHORUS_DELAY    = 2
+        self._shadow_global = bytearray([self.SHADOW_UNKNOWN] * 3)
+
+        # Controller thinning: control changes and pitch bends received in a time slice
+        # are sent once with the latest value, and the same value as sent last is dropped.
+        self.COALESCE_MS = 10					# Time slice (0: no thinning, repeats are still dropped)
+        self.COALESCE_NONE = 0xFF
+        self.COALESCE_PITCH_BEND = 16 * 128		# Key of pitch bend, key of control change is CHANNEL * 128 + CONTROL
+        self._cc_pending = bytearray([self.COALESCE_NONE] * (16 * 128))
+        self._cc_sent    = bytearray([self.COALESCE_NONE] * (16 * 128))
+        self._bend_pending = [None] * 16
+        self._bend_sent    = [None] * 16
+        self._cc_route   = bytearray(16 * 128)	# Routes of the values pending (of the source received from)
+        self._bend_route = bytearray(16)
+        self._coalesce_keys = []				# Keys pending in the order received
+
+        # Controllers sent at once in the order received, never thinned nor dropped as repeats:
+        # bank select, data entry, data increment/decrement, (N)RPN select and channel mode messages
+        self._cc_immediate = bytearray(128)
+        for control in (0, 32, 6, 38, 96, 97, 98, 99, 100, 101, 120, 121, 122, 123, 124, 125, 126, 127):
+            self._cc_immediate[control] = 1
+        self._coalesce_channels = bytearray(16)	# Number of the controllers pending in each channel
+        self._coalesce_t0 = 0
+
+        # Control change mapping for each control number
+        self.CC_MAP_PASS  = 0					# Send as a control change
+        self.CC_MAP_NRPN  = 1					# Send as an NRPN, see _cc_nrpn
+        self.CC_MAP_SYSEX = 2					# Send as a GS SysEx, see set_modulation_wheel()
+        self.CC_MAP_DROP  = 3					# Do not send
+        self._cc_map = bytearray([self.CC_MAP_PASS] * 128)
+        self._cc_nrpn = [None] * 128			# (NRPN MSB, NRPN LSB) for CC_MAP_NRPN
+
+        # Passthrough mode in USB host mode: USB-MIDI events are classified by
+        # the status nibble and forwarded as received without message objects.
+        # Messages that need to be transformed still go through midi_dispatch().
+        self.PASSTHROUGH_RAW    = 1
+        self.PASSTHROUGH_OBJECT = 2
+        self.PASSTHROUGH_SYSTEM = 3				# SysEx and Real-Time are RAW, others are OBJECT
+        self._midi_passthrough = True
+        self._passthrough_actions = bytearray([
+            self.PASSTHROUGH_RAW] * 8 + [		# 0x0-0x7: SysEx data
+            self.PASSTHROUGH_RAW,				# 0x8: Note Off
+            self.PASSTHROUGH_RAW,				# 0x9: Note On
+            self.PASSTHROUGH_RAW,				# 0xA: Polyphonic Key Pressure
+            self.PASSTHROUGH_OBJECT,			# 0xB: Control Change
+            self.PASSTHROUGH_OBJECT,			# 0xC: Program Change
+            self.PASSTHROUGH_RAW,				# 0xD: Channel Pressure
+            self.PASSTHROUGH_OBJECT,			# 0xE: Pitch Bend
+            self.PASSTHROUGH_SYSTEM				# 0xF: System
+        ])
+        self._event_buf = bytearray(3)
+        event_view = memoryview(self._event_buf)
+        self._event_views = (None, event_view[:1], event_view[:2], event_view[:3])
+        self._event_pool = MessagePool(1)
         
         print('USB PORTS:', usb_midi.ports)
         display.fill(0)
@@ -242,12 +926,13 @@ class MIDIUnit_class:
         self.midi_in_file_number = 0
         self.midi_in_settings = []                        # MIDI IN settings for each channel, see setup()
                                                           # Each channel has following data structure
-                                                          #     {'program':0, 'gmbank':0, 'reverb':[0,0,0], 'chorus':[0,0,0,0], 'vibrate':[0,0,0]}
-                                                          #     {'program':PROGRAM, 'gmbank':GM BANK, 'reverb':[PROGRAM,LEVEL,FEEDBACK], 'chorus':[PROGRAM,LEVEL,FEEDBACK,DELAY], 'vibrate':[RATE,DEPTH,DELAY]}
+                                                          #     {'program':0, 'gmbank':0, 'reverb':[0,0,0], 'chorus':[0,0,0,0], 'vibrate':[0,0,0], 'route':[3,3,3], 'velocity':[0,100,0,32,64,96,127]}
+                                                          #     {'program':PROGRAM, 'gmbank':GM BANK, 'reverb':[PROGRAM,LEVEL,FEEDBACK], 'chorus':[PROGRAM,LEVEL,FEEDBACK,DELAY], 'vibrate':[RATE,DEPTH,DELAY], 'route':[USB HOST,USB DEVICE,UART1], 'velocity':[CURVE,FIXED,OUT0,OUT32,OUT64,OUT96,OUT127]}
         for ch in list(range(16)):
-            self.midi_in_settings.append({'program':ch, 'gmbank':0, 'reverb':[0,0,0], 'chorus':[0,0,0,0], 'vibrate':[0,0,0]})
+            self.midi_in_settings.append({'program':ch, 'gmbank':0, 'reverb':[0,0,0], 'chorus':[0,0,0,0], 'vibrate':[0,0,0], 'route':[self.ROUTE_DEFAULT] * self.ROUTE_SOURCES, 'velocity':list(self.VELOCITY_DEFAULT)})
             self.set_pitch_bend_range(ch, 5)
 
+        self.midi_route_compile()
         self.get_midiset_list()
 
     # Is host mode or not
@@ -265,15 +950,120 @@ class MIDIUnit_class:
     def midi_out_to(self, uart_unit, flg=None):
         if uart_unit == 0:
             if flg is not None:
+                # The synthesizer newly connected has not been sent the settings
+                if flg and not self._midi_out_uart0:
+                    self.midi_invalidate_settings()
                 self._midi_out_uart0 = flg
+                self.midi_route_compile()
             return self._midi_out_uart0
         elif uart_unit == 1:
             if flg is not None:
+                if flg and not self._midi_out_uart1:
+                    self.midi_invalidate_settings()
                 self._midi_out_uart1 = flg
+                self.midi_route_compile()
             return self._midi_out_uart1
                     
         return False
     
+    # Set/Get routing destinations (ROUTE_* bit mask) of a source and a channel
+    def midi_route(self, source, channel, dest=None):
+        route = self.midi_in_settings[channel % 16]['route']
+        if dest is not None:
+            route[source % self.ROUTE_SOURCES] = dest & (self.ROUTE_UART0 | self.ROUTE_UART1 | self.ROUTE_USB)
+            self.midi_route_compile()
+
+        return route[source % self.ROUTE_SOURCES]
+
+    # Compile the routing matrix and MIDI-OUT selectors into the routing tables
+    def midi_route_compile(self):
+        # End the messages forwarded and release the notes to the routes they were sent before the routes change
+        self.midi_out_end_stream()
+        self.midi_release_notes()
+
+        # The new destinations have not got the controller values sent before
+        self.midi_coalesce_forget()
+
+        enabled = self.ROUTE_USB
+        if self._midi_out_uart0:
+            enabled |= self.ROUTE_UART0
+        if self._midi_out_uart1 and self._uart1_out is not None:
+            enabled |= self.ROUTE_UART1
+
+        for source in range(self.ROUTE_SOURCES):
+            table = self._route_tables[source]
+            system = 0
+            for ch in range(16):
+                table[ch] = self.midi_in_settings[ch]['route'][source] & enabled
+                system |= table[ch]
+
+            self._route_system[source] = system
+
+        self._route_local = enabled & ~self.ROUTE_USB
+        self._route = self._route_local
+        for ch in range(16):
+            self._route_release[ch] = self._route_local | self._route_tables[0][ch] | self._route_tables[1][ch] | self._route_tables[2][ch]
+
+    # Make the velocity table of a channel from the settings
+    def midi_velocity_compile(self, channel):
+        velocity = self.midi_in_settings[channel]['velocity']
+        curve = velocity[0]
+        table = self._velocity_tables[channel]
+        for v in range(1, 128):
+            if   curve == self.VELOCITY_SOFT:
+                out = int(127 * (v / 127) ** 0.5 + 0.5)
+            elif curve == self.VELOCITY_HARD:
+                out = int(v * v / 127 + 0.5)
+            elif curve == self.VELOCITY_FIXED:
+                out = velocity[1]
+            elif curve == self.VELOCITY_CUSTOM:
+                # Linear interpolation between the points
+                p = 1
+                while self.VELOCITY_POINTS[p] < v:
+                    p += 1
+                x0 = self.VELOCITY_POINTS[p - 1]
+                x1 = self.VELOCITY_POINTS[p]
+                out = velocity[p + 1] + ((velocity[p + 2] - velocity[p + 1]) * (v - x0) + (x1 - x0) // 2) // (x1 - x0)
+            else:
+                out = v
+
+            # Velocity 0 is note off
+            table[v] = min(max(out, 1), 127)
+
+    # Set/Get the velocity curve of a channel (VELOCITY_*)
+    def midi_velocity_curve(self, channel, curve=None):
+        velocity = self.midi_in_settings[channel % 16]['velocity']
+        if curve is not None:
+            velocity[0] = curve % self.VELOCITY_CURVES
+            self.midi_velocity_compile(channel % 16)
+
+        return velocity[0]
+
+    # Set/Get the fixed velocity (point=None) or the output velocity of a custom curve point
+    def midi_velocity_value(self, channel, point=None, value=None):
+        velocity = self.midi_in_settings[channel % 16]['velocity']
+        idx = 1 if point is None else point % len(self.VELOCITY_POINTS) + 2
+        if value is not None:
+            velocity[idx] = value % 128
+            self.midi_velocity_compile(channel % 16)
+
+        return velocity[idx]
+
+    # Set/Get running status mode of MIDI-OUT to UARTs
+    def midi_out_running_status(self, flg=None):
+        self._uart0_out.running_status(flg)
+        if self._uart1_out is not None:
+            self._uart1_out.running_status(flg)
+
+        return self._uart0_out.running_status()
+
+    # Set/Get passthrough mode in USB host mode
+    def midi_passthrough(self, flg=None):
+        if flg is not None:
+            self._midi_passthrough = flg
+
+        return self._midi_passthrough
+
     # Look for USB MIDI device
     def look_for_usb_midi_device(self):
         self._raw_midi_host = None
@@ -289,7 +1079,7 @@ class MIDIUnit_class:
 
             try_count = try_count - 1
             led_flush = not led_flush
-            pico_led.value = led_flush
+            pico_led.value(led_flush)
             
             devices_found = usb.core.find(find_all=True)
 
@@ -342,13 +1132,13 @@ class MIDIUnit_class:
         if self._raw_midi_host is None:
             self._usb_midi_host = None
             self._usb_host_mode = False
-            pico_led.value = False
+            pico_led.value(False)
             return None
         
-        self._usb_midi_host = adafruit_midi.MIDI(midi_in=self._raw_midi_host)  
+        self._usb_midi_host = adafruit_midi.MIDI(midi_in=self._raw_midi_host, pool_size=self.MIDI_POOL_SIZE, sysex_handler=self.midi_sysex_out, realtime_handler=self.midi_realtime_out)
 #        self._usb_midi_host = adafruit_midi.MIDI(midi_in=self._raw_midi_host, in_channel=0)  
 #        self._usb_midi = adafruit_midi.MIDI(midi_in=usb_midi.ports[0], in_channel=0, midi_out=usb_midi.ports[1], out_channel=0)
-        pico_led.value = True
+        pico_led.value(True)
         return self._usb_midi_host
 
     def usb_midi_host(self):
@@ -377,15 +1167,8 @@ class MIDIUnit_class:
 #                        return instrument
 
         except Exception as e:
-            application.show_message('GM LIST:' + e)
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('GM LIST:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
 
         return '???'
 
@@ -454,7 +1237,17 @@ class MIDIUnit_class:
             # SD card file system
             settings = sdcard.json_read('/SD/SYNTH/MIDIUNIT/', 'MIDISET{:03d}.json'.format(num))
             if settings is not None:
+                # Files saved before routing was introduced
+                for channel_settings in settings:
+                    if 'route' not in channel_settings:
+                        channel_settings['route'] = [self.ROUTE_DEFAULT] * self.ROUTE_SOURCES
+                    if 'velocity' not in channel_settings:
+                        channel_settings['velocity'] = list(self.VELOCITY_DEFAULT)
+
                 self.midi_in_settings = settings
+                self.midi_route_compile()
+                for ch in range(16):
+                    self.midi_velocity_compile(ch)
                 print(self.midi_in_settings)
 
             # PICO internal memory file system
@@ -463,15 +1256,8 @@ class MIDIUnit_class:
 #                print(self.midi_in_settings)
 
         except Exception as e:
-            application.show_message('ERROR:' + str(e))
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('ERROR:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
 
     # Save MIDI settings
     def save_midi_settings(self, num=None):
@@ -495,130 +1281,470 @@ class MIDIUnit_class:
 #                self.get_midiset_list(num)
         
         except Exception as e:
-            application.show_message('ERROR:' + str(e))
-            for cnt in list(range(5)):
-                pico_led.value = False
-                sleep(0.25)
-                pico_led.value = True
-                sleep(0.5)
-
-            display.clear()
-            application.show_midi_channel(True, True)
+            application.queue_message('ERROR:' + str(e))
+            pico_led.blink(False, (250, 500), 5)
        
     # MIDI-IN via a port of the current mode
+    #   USB  : returns a list of all the MIDI messages received
+    #   UART1: returns all the bytes waiting in the UART, or None
     def midi_in(self):            
         # MIDI-IN via USB
         if self._midi_in_usb:
             try:
                 if self._usb_host_mode:
-                    midi_msg = self._usb_midi_host.receive()
+                    self._route_source = self.ROUTE_SOURCE_USB_HOST
+                    midi_msgs = self._usb_midi_host.receive_many()
                 else:
-                    midi_msg = self._usb_midi.receive()
+                    self._route_source = self.ROUTE_SOURCE_USB_DEVICE
+                    midi_msgs = self._usb_midi.receive_many()
 
             except:
-                print('CHANGE TO DEVICE MODE')
-                self._usb_host_mode = False
-                midi_msg = self._usb_midi.receive()
-                display.clear()
-                application.show_midi_channel(True, True)
+                self.change_to_device_mode()
+                self._route_source = self.ROUTE_SOURCE_USB_DEVICE
+                midi_msgs = self._usb_midi.receive_many()
                 
-            return midi_msg
+            return midi_msgs
                     
         # MIDI-IN via UART (unit1)
         elif self._uart1 is not None:
             try:
-                midi_msg = self._uart1.read(1)
-                return midi_msg
+                num = self._uart1.in_waiting
+                if num > 0:
+                    return self._uart1.read(num)
 
             except Exception as e:
                 print('EXCEPTION: UART MIDI-IN:', e)
-                return None
             
         return None
 
+    # MIDI-IN via USB host in passthrough mode
+    #   Plays the USB-MIDI events of a USB transfer, returns the number of events
+    def midi_in_passthrough(self):
+        event = self._event_buf
+        num_events = 0
+        try:
+            num = self._raw_midi_host.read_event(event)
+
+        except:
+            self.change_to_device_mode()
+            return num_events
+
+        if num > 0 and self._monitor.enabled():
+            self.midi_monitor_arrival()
+
+        self._route_source = self.ROUTE_SOURCE_USB_HOST
+        route_table = self._route_tables[self.ROUTE_SOURCE_USB_HOST]
+        route_system = self._route_system[self.ROUTE_SOURCE_USB_HOST]
+        while num > 0:
+            num_events = num_events + 1
+            action = self._passthrough_actions[event[0] >> 4]
+            if action == self.PASSTHROUGH_SYSTEM:
+                action = self.PASSTHROUGH_RAW if event[0] >= 0xF8 or event[0] == 0xF0 or event[0] == 0xF7 else self.PASSTHROUGH_OBJECT
+
+            if action == self.PASSTHROUGH_RAW:
+                # Controllers pending go before a note on the same channel
+                if 0x80 <= event[0] and event[0] < 0xF0 and self._coalesce_channels[event[0] & 0x0F]:
+                    self.midi_coalesce_flush(True)
+
+                # Note on/off
+                if 0x80 <= event[0] and event[0] < 0xA0:
+                    if event[0] >= 0x90:
+                        event[2] = self._velocity_tables[event[0] & 0x0F][event[2]]
+                    self.track_note(event[0] & 0x0F, event[1], event[2] if event[0] >= 0x90 else 0)
+
+                # Channel messages or SysEx
+                self.midi_out(self._event_views[num], route_table[event[0] & 0x0F] if 0x80 <= event[0] and event[0] < 0xF0 else route_system, True)
+
+            elif action == self.PASSTHROUGH_OBJECT:
+                midi_msg = MIDIMessage.from_message_bytes(event, self._usb_midi_host.in_channel, 0, num, self._event_pool, self._usb_midi_host.in_channel_mask)[0]
+                if midi_msg is not None:
+                    self.midi_dispatch(midi_msg)
+
+            # Only the events already received, do not wait for another USB transfer
+            if not self._raw_midi_host.event_waiting:
+                break
+
+            num = self._raw_midi_host.read_event(event)
+
+        return num_events
+
+    # USB host is not available any more
+    def change_to_device_mode(self):
+        print('CHANGE TO DEVICE MODE')
+        self._usb_host_mode = False
+
+        # The USB keyboard unplugged will not end its messages nor send note offs
+        self.midi_out_end_stream()
+        self.midi_release_notes()
+        display.clear()
+        application.show_midi_channel(True, True)
+
     def midi_send(self, midi_msg):
         self._usb_midi.send(NoteOn(note_key, velosity))
 
-    # MIDI-OUT to UART MIDI
-    def midi_out(self, midi_msg):
-        if self._midi_out_uart0:
-            self._uart0.write(midi_msg)
-
-        if self._midi_out_uart1 and self._uart1 is not None:
-            self._uart1.write(midi_msg)
+    # End the messages forwarded to the UARTs and send the local messages held
+    def midi_out_end_stream(self):
+        self._uart0_out.end_stream()
+        if self._uart1_out is not None:
+            self._uart1_out.end_stream()
+
+    # Forward a chunk of SysEx to MIDI-OUT (sysex_handler of adafruit_midi.MIDI)
+    def midi_sysex_out(self, data, first, last):
+        self.midi_out(data, self._route_system[self._route_source], True)
+
+    # Forward a System Real-Time message to MIDI-OUT (realtime_handler of adafruit_midi.MIDI)
+    def midi_realtime_out(self, status):
+        self._realtime_buf[0] = status
+        self.midi_out(self._realtime_buf, self._route_system[self._route_source], True)
+
+    # Send the MIDI-OUT messages queued as far as the UARTs can take without blocking
+    # Call this once per main loop pass.
+    #   force: send all the messages queued even if the UARTs block
+    def midi_out_flush(self, force=False):
+        num = 0
+        if not self.midi_out_idle():
+            t0 = supervisor.ticks_ms()
+            num = self._uart0_out.pump(force)
+            if self._uart1_out is not None:
+                num += self._uart1_out.pump(force)
+
+            self.flush_ms = ticks_diff(supervisor.ticks_ms(), t0)
+
+        # All the settings have been sent (or nothing had to be sent)
+        if self._settings_t0 is not None and self.midi_out_idle():
+            self.settings_flush_ms = ticks_diff(supervisor.ticks_ms(), self._settings_t0)
+            self._settings_t0 = None
+            print('SETTINGS SENT in', self.settings_flush_ms, 'ms')
+
+        return num
+
+    # Nothing queued to the UARTs
+    def midi_out_idle(self):
+        return self._uart0_out.is_idle() and (self._uart1_out is None or self._uart1_out.is_idle())
+
+    # Queue depth, maximum queue depth and maximum latency of MIDI-OUT
+    def midi_out_queue_status(self):
+        depth = self._uart0_out.queue_depth()
+        max_depth = self._uart0_out.max_depth
+        max_latency = self._uart0_out.max_latency_ms
+        if self._uart1_out is not None:
+            depth = max(depth, self._uart1_out.queue_depth())
+            max_depth = max(max_depth, self._uart1_out.max_depth)
+            max_latency = max(max_latency, self._uart1_out.max_latency_ms)
+
+        return (depth, max_depth, max_latency)
+
+    # MIDI-IN to MIDI-OUT instrumentation
+    def midi_monitor(self):
+        return self._monitor
+
+    # Bytes skipped by the USB MIDI-IN parsers
+    def midi_skipped_bytes(self):
+        skipped = self._usb_midi._skipped_bytes
+        if self._usb_midi_host is not None:
+            skipped += self._usb_midi_host._skipped_bytes
+
+        return skipped
+
+    # MIDI-IN arrived now, the messages written to MIDI-OUT until midi_monitor_processed() are measured from here
+    def midi_monitor_arrival(self):
+        self._arrival_ns = monotonic_ns()
+        stamp = supervisor.ticks_ms()
+        self._uart0_out.stamp_ms = stamp
+        if self._uart1_out is not None:
+            self._uart1_out.stamp_ms = stamp
+
+    # The messages (num) arrived have been dispatched
+    def midi_monitor_processed(self, num):
+        self._uart0_out.stamp_ms = None
+        if self._uart1_out is not None:
+            self._uart1_out.stamp_ms = None
+
+        if num > 0:
+            self._monitor.processed(self._arrival_ns, num)
+
+    # Dump the instrumentation to the serial console
+    def midi_monitor_dump(self):
+        self._monitor.print_statistics(self.midi_skipped_bytes())
+        for uart_out in (self._uart0_out, self._uart1_out):
+            if uart_out is not None:
+                print('  UART: bytes in={} out={} writes={} max depth={} max latency={}ms overflows={} dropped={}'.format(uart_out.bytes_in, uart_out.bytes_out, uart_out.writes, uart_out.max_depth, uart_out.max_latency_ms, uart_out.overflows, uart_out.dropped))
+
+    # MIDI-OUT to UART MIDI (queued until midi_out_flush()) and USB device MIDI
+    #   route : destinations (ROUTE_* bit mask), None is the current routes
+    #   stream: bytes forwarded from MIDI-IN (may be a part of a message),
+    #           otherwise whole messages generated locally
+    def midi_out(self, midi_msg, route=None, stream=False):
+        if route is None:
+            route = self._route
+
+        if route & self.ROUTE_UART0:
+            if stream:
+                self._uart0_out.write_stream(midi_msg)
+            else:
+                self._uart0_out.write(midi_msg)
 
-    # Receive MIDI via USB MIDI host, then send it to UART and USB MIDI device
+        if route & self.ROUTE_UART1:
+            if stream:
+                self._uart1_out.write_stream(midi_msg)
+            else:
+                self._uart1_out.write(midi_msg)
+
+        if route & self.ROUTE_USB:
+            self._usb_midi_out.write(midi_msg)
+
+    # Send MIDI bytes received via UART1 to the routes of each message
+    def midi_route_uart1(self, midi_bytes):
+        route_table = self._route_tables[self.ROUTE_SOURCE_UART1]
+        route_system = self._route_system[self.ROUTE_SOURCE_UART1]
+        view = memoryview(midi_bytes)
+        route = self._uart1_route
+        start = 0
+        for i in range(len(midi_bytes)):
+            b = midi_bytes[i]
+            if b < 0x80:
+                continue
+
+            # System Real-Time is sent alone
+            if b >= 0xF8:
+                if i > start and route:
+                    self.midi_out(view[start:i], route, True)
+                if route_system:
+                    self.midi_out(view[i:i + 1], route_system, True)
+                start = i + 1
+                continue
+
+            # A new message, send the bytes before it
+            new_route = route_table[b & 0x0F] if b < 0xF0 else route_system
+            if new_route != route:
+                if i > start and route:
+                    self.midi_out(view[start:i], route, True)
+                start = i
+                route = new_route
+
+        if len(midi_bytes) > start and route:
+            self.midi_out(view[start:], route, True)
+
+        self._uart1_route = route
+
+    # Receive MIDI via UART1, then send it to UART
     def midi_in_out(self):
         midi_msg = self.midi_in()
-        if not midi_msg is None:
-            self.midi_out(midi_msg)
+        if not midi_msg is None and not self._midi_in_usb:
+            self.midi_route_uart1(midi_msg)
 #            self.midi_send(midi_msg)
     
+    # Set the checksum of a GS SysEx message with 3 address bytes and 1 data byte
+    def set_gs_checksum(self, midi_msg):
+        midi_msg[9] = (128 - (midi_msg[5] + midi_msg[6] + midi_msg[7] + midi_msg[8]) % 128) % 128
+
     def set_master_volume(self, vol=127):
-        midi_msg = bytearray([0xF0, 0x7F, 0x7F, 0x04, 0x01, 0, vol & 0x7f, 0xF7])
+        midi_msg = self._msg_master_volume
+        midi_msg[6] = vol & 0x7f
         self.midi_out(midi_msg)
 
-    def set_instrument(self, channel=0, prog=0, gmbank=0):
-        midi_msg = bytearray([0xC0 + channel, prog])
+    # Forget the settings sent, the next midi_instrument() and midi_effectors() send everything
+    def midi_invalidate_settings(self):
+        for shadow in self._shadow:
+            for i in range(self.SHADOW_SIZE):
+                shadow[i] = self.SHADOW_UNKNOWN
+
+        for i in range(len(self._shadow_global)):
+            self._shadow_global[i] = self.SHADOW_UNKNOWN
+
+        self.midi_coalesce_forget()
+
+    # Setters with delta=True send only the values differing from the shadow
+    def set_instrument(self, channel=0, prog=0, gmbank=0, delta=False):
+        shadow = self._shadow[channel]
+        if delta and shadow[self.SHADOW_PROGRAM] == prog:
+            return
+
+        midi_msg = self._msg_instrument
+        midi_msg[0] = 0xC0 + channel
+        midi_msg[1] = prog
         self.midi_out(midi_msg)
+        shadow[self.SHADOW_PROGRAM] = prog
+
+    # Keep the active notes bitmap up to date
+    def track_note(self, channel, note_key, velosity):
+        idx = channel * 16 + (note_key >> 3)
+        bit = 1 << (note_key & 0x07)
+        if velosity > 0:
+            if not self._active_notes[idx] & bit:
+                self._active_notes[idx] |= bit
+                self._active_count[channel] += 1
+
+        elif self._active_notes[idx] & bit:
+            self._active_notes[idx] &= ~bit
+            self._active_count[channel] -= 1
+
+    # Is the note sounding or not
+    def note_active(self, channel, note_key):
+        return (self._active_notes[channel * 16 + (note_key >> 3)] & (1 << (note_key & 0x07))) != 0
+
+    # Send note offs of the notes sounding (in a channel, or all the channels if None)
+    def midi_release_notes(self, channel=None):
+        route = self._route
+        for ch in (range(16) if channel is None else (channel,)):
+            if self._active_count[ch] == 0:
+                continue
+
+            self._route = self._route_release[ch]
+            for idx in range(ch * 16, ch * 16 + 16):
+                bits = self._active_notes[idx]
+                if bits == 0:
+                    continue
+
+                note_key = (idx - ch * 16) << 3
+                while bits:
+                    if bits & 0x01:
+                        self.set_note_off(ch, note_key)
 
+                    bits >>= 1
+                    note_key += 1
+
+        self._route = route
+
+    # velosity is mapped with the velocity curve of the channel
     def set_note_on(self, channel, note_key, velosity):
-        midi_msg = bytearray([0x90 + channel, note_key, velosity])
+        velosity = self._velocity_tables[channel][velosity]
+        self.track_note(channel, note_key, velosity)
+        midi_msg = self._msg_note
+        midi_msg[0] = 0x90 + channel
+        midi_msg[1] = note_key
+        midi_msg[2] = velosity
         self.midi_out(midi_msg)
 
     def set_note_off(self, channel, note_key):
-        midi_msg = bytearray([0x90 + channel, note_key, 0])
-        self.midi_out(midi_msg)
+        self.set_note_on(channel, note_key, 0)
+
+    # Send a channel message generated (by the sequencer), notes go through the velocity curve and note tracking
+    def midi_send_event(self, midi_msg):
+        status = midi_msg[0] & 0xF0
+        if status == 0x90:
+            self.set_note_on(midi_msg[0] & 0x0F, midi_msg[1], midi_msg[2])
+        elif status == 0x80:
+            self.set_note_off(midi_msg[0] & 0x0F, midi_msg[1])
+        else:
+            self.midi_out(midi_msg)
 
-    def set_all_notes_off(self, channel = None):
-        if channel is not None:
-            midi_msg = bytearray([0xB0 + channel, 0x78, 0])
+    # Panic: release the notes sounding (in a channel, or all the channels if None)
+    #   untracked: also send All Notes Off, for the notes not tracked (after power on)
+    def set_all_notes_off(self, channel = None, untracked=False):
+        self.midi_release_notes(channel)
+        if not untracked:
+            return
+
+        midi_msg = self._msg_all_notes_off
+        for ch in (range(16) if channel is None else (channel,)):
+            midi_msg[0] = 0xB0 + ch
             self.midi_out(midi_msg)
-        else:
-            for channel in list(range(16)):
-                midi_msg = bytearray([0xB0 + channel, 0x78, 0])
-                self.midi_out(midi_msg)
                 
-    def set_reverb(self, channel, prog, level, feedback):
-        status_byte = 0xB0 + channel
-        midi_msg = bytearray([status_byte, 0x50, prog, status_byte, 0x5B, level])
-        self.midi_out(midi_msg)
-        if feedback > 0:
-            midi_msg = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x35, feedback, 0, 0xF7])
+    def set_reverb(self, channel, prog, level, feedback, delta=False):
+        shadow = self._shadow[channel]
+        sh = self.SHADOW_REVERB
+        if not delta or shadow[sh] != prog or shadow[sh + 1] != level:
+            status_byte = 0xB0 + channel
+            midi_msg = self._msg_reverb
+            midi_msg[0] = status_byte
+            midi_msg[2] = prog
+            midi_msg[3] = status_byte
+            midi_msg[5] = level
             self.midi_out(midi_msg)
+            shadow[sh] = prog
+            shadow[sh + 1] = level
+
+        if feedback > 0 and (not delta or self._shadow_global[self.SHADOW_REVERB_FEEDBACK] != feedback):
+            midi_msg = self._msg_reverb_feedback
+            midi_msg[8] = feedback
+            self.set_gs_checksum(midi_msg)
+            self.midi_out(midi_msg)
+            self._shadow_global[self.SHADOW_REVERB_FEEDBACK] = feedback
             
-    def set_chorus(self, channel, prog, level, feedback, delay):
-        status_byte = 0xB0 + channel
-        midi_msg = bytearray([status_byte, 0x51, prog, status_byte, 0x5D, level])
-        self.midi_out(midi_msg)
-        if feedback > 0:
-            midi_msg = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x3B, feedback, 0, 0xF7])
+    def set_chorus(self, channel, prog, level, feedback, delay, delta=False):
+        shadow = self._shadow[channel]
+        sh = self.SHADOW_CHORUS
+        if not delta or shadow[sh] != prog or shadow[sh + 1] != level:
+            status_byte = 0xB0 + channel
+            midi_msg = self._msg_chorus
+            midi_msg[0] = status_byte
+            midi_msg[2] = prog
+            midi_msg[3] = status_byte
+            midi_msg[5] = level
+            self.midi_out(midi_msg)
+            shadow[sh] = prog
+            shadow[sh + 1] = level
+
+        if feedback > 0 and (not delta or self._shadow_global[self.SHADOW_CHORUS_FEEDBACK] != feedback):
+            midi_msg = self._msg_chorus_feedback
+            midi_msg[8] = feedback
+            self.set_gs_checksum(midi_msg)
             self.midi_out(midi_msg)
+            self._shadow_global[self.SHADOW_CHORUS_FEEDBACK] = feedback
 
-        if delay > 0:
-            midi_msg = bytearray([0xF0, 0x41, 0x00, 0x42, 0x12, 0x40, 0x01, 0x3C, delay, 0, 0xF7])
+        if delay > 0 and (not delta or self._shadow_global[self.SHADOW_CHORUS_DELAY] != delay):
+            midi_msg = self._msg_chorus_delay
+            midi_msg[8] = delay
+            self.set_gs_checksum(midi_msg)
             self.midi_out(midi_msg)
+            self._shadow_global[self.SHADOW_CHORUS_DELAY] = delay
+
+    def set_vibrate(self, channel, rate, depth, delay, delta=False):
+        shadow = self._shadow[channel]
+        sh = self.SHADOW_VIBRATE
+        if delta and shadow[sh] == rate and shadow[sh + 1] == depth and shadow[sh + 2] == delay:
+            return
 
-    def set_vibrate(self, channel, rate, depth, delay):
+        shadow[sh] = rate
+        shadow[sh + 1] = depth
+        shadow[sh + 2] = delay
         status_byte = 0xB0 + channel
-        midi_msg = bytearray([status_byte, 0x63, 0x01, 0x62, 0x08, 0x06, rate, status_byte, 0x63, 0x01, 0x62, 0x09, 0x06, depth, status_byte, 0x63, 0x01, 0x62, 0x0A, 0x06, delay])
+        midi_msg = self._msg_vibrate
+        midi_msg[0] = status_byte
+        midi_msg[6] = rate
+        midi_msg[7] = status_byte
+        midi_msg[13] = depth
+        midi_msg[14] = status_byte
+        midi_msg[20] = delay
         self.midi_out(midi_msg)
 
+    # value: -8192..8191 (0 is the center)
     def set_pitch_bend(self, channel, value):
-        status_byte = 0xE0 + channel
-        lsb = value & 0x7f					# Least
-        msb = (value >> 7) & 0x7f			# Most
-        midi_msg = bytearray([status_byte, lsb, msb])
+        value = value + 8192
+        midi_msg = self._msg_pitch_bend
+        midi_msg[0] = 0xE0 + channel
+        midi_msg[1] = value & 0x7f					# Least
+        midi_msg[2] = (value >> 7) & 0x7f			# Most
         self.midi_out(midi_msg)
 
     def set_pitch_bend_range(self, channel, value):
-        status_byte = 0xB0 + channel
-        midi_msg = bytearray([status_byte, 0x65, 0x00, 0x64, 0x00, 0x06, value & 0x7f])
+        midi_msg = self._msg_pitch_bend_range
+        midi_msg[0] = 0xB0 + channel
+        midi_msg[6] = value & 0x7f
+        self.midi_out(midi_msg)
+
+    def set_control_change(self, channel, control, value):
+        midi_msg = self._msg_control_change
+        midi_msg[0] = 0xB0 + channel
+        midi_msg[1] = control
+        midi_msg[2] = value
+        self.midi_out(midi_msg)
+
+    def set_nrpn(self, channel, msb, lsb, value):
+        midi_msg = self._msg_nrpn
+        midi_msg[0] = 0xB0 + channel
+        midi_msg[2] = msb
+        midi_msg[4] = lsb
+        midi_msg[6] = value
         self.midi_out(midi_msg)
 
     def set_modulation_wheel(self, channel, modulation, value):
-        status_byte = 0xB0 + channel
-        midi_msg = bytearray([status_byte, 0x41, 0x00, 0x42, 0x12, 0x40, (0x20 | (channel & 0x0f)), modulation, value, 0x00, 0xF7])
+        midi_msg = self._msg_modulation
+        midi_msg[6] = 0x20 | (channel & 0x0f)
+        midi_msg[7] = modulation
+        midi_msg[8] = value
+        self.set_gs_checksum(midi_msg)
         self.midi_out(midi_msg)
 
     def midi_master_volume(self, vol=None):
@@ -628,7 +1754,8 @@ class MIDIUnit_class:
         
         return self.master_volume
 
-    def midi_instrument(self, channel=None, program=None, gmbank=0):
+    # force: send the settings even if the synthesizer already has them
+    def midi_instrument(self, channel=None, program=None, gmbank=0, force=False):
         if (channel is not None) and (program is not None):
             channel = channel % 16
             program = program % 128
@@ -642,16 +1769,27 @@ class MIDIUnit_class:
             
         elif (channel is None) and (program is None):
             for channel in list(range(16)):
-                self.set_instrument(channel, self.midi_in_settings[channel]['program'], self.midi_in_settings[channel]['gmbank'])
+                self.set_instrument(channel, self.midi_in_settings[channel]['program'], self.midi_in_settings[channel]['gmbank'], not force)
 
     def midi_get_instrument(self, channel, gmbank=0):
         return self.midi_in_settings[channel % 16]['program']
     
-    def midi_effectors(self):
+    # force: send the settings even if the synthesizer already has them
+    def midi_effectors(self, force=False):
         for channel in list(range(16)):
-            self.set_reverb(channel, self.midi_in_settings[channel]['reverb'][0], self.midi_in_settings[channel]['reverb'][1], self.midi_in_settings[channel]['reverb'][2])
-            self.set_chorus(channel, self.midi_in_settings[channel]['chorus'][0], self.midi_in_settings[channel]['chorus'][1], self.midi_in_settings[channel]['chorus'][2], self.midi_in_settings[channel]['chorus'][3])
-            self.set_vibrate(channel, self.midi_in_settings[channel]['vibrate'][0], self.midi_in_settings[channel]['vibrate'][1], self.midi_in_settings[channel]['vibrate'][2])
+            self.set_reverb(channel, self.midi_in_settings[channel]['reverb'][0], self.midi_in_settings[channel]['reverb'][1], self.midi_in_settings[channel]['reverb'][2], not force)
+            self.set_chorus(channel, self.midi_in_settings[channel]['chorus'][0], self.midi_in_settings[channel]['chorus'][1], self.midi_in_settings[channel]['chorus'][2], self.midi_in_settings[channel]['chorus'][3], not force)
+            self.set_vibrate(channel, self.midi_in_settings[channel]['vibrate'][0], self.midi_in_settings[channel]['vibrate'][1], self.midi_in_settings[channel]['vibrate'][2], not force)
+
+    # Send instruments and effectors of all channels changed
+    # They are sent in the background by midi_out_flush(), notes played meanwhile go first.
+    #   force: full resync, send all the settings
+    def midi_send_settings(self, force=False):
+        self._settings_t0 = supervisor.ticks_ms()
+        self.midi_release_notes()
+        self.midi_instrument(force=force)
+        self.midi_effectors(force)
+        self.midi_out_flush()
 
     def midi_reverb(self, channel, param, value):
         channel = channel % 16
@@ -701,77 +1839,267 @@ class MIDIUnit_class:
         else:
             return self.midi_in_settings[channel]['vibrate'][param % 3]
 
+    # Set/Get the mapping of a control change number
+    #   action: CC_MAP_*
+    #   nrpn  : (NRPN MSB, NRPN LSB) for CC_MAP_NRPN
+    def midi_cc_map(self, control, action=None, nrpn=None):
+        control = control % 128
+        if action is not None:
+            if action == self.CC_MAP_NRPN and nrpn is None and self._cc_nrpn[control] is None:
+                raise ValueError('NRPN is not specified for CC{}'.format(control))
+
+            self._cc_map[control] = action
+            if nrpn is not None:
+                self._cc_nrpn[control] = nrpn
+
+        return self._cc_map[control]
+
+    # Send a control change received as the mapping
+    def midi_control_change(self, channel, control, value):
+        action = self._cc_map[control]
+        if action == self.CC_MAP_PASS:
+            self.set_control_change(channel, control, value)
+
+        elif action == self.CC_MAP_NRPN:
+            nrpn = self._cc_nrpn[control]
+            self.set_nrpn(channel, nrpn[0], nrpn[1], value)
+
+        elif action == self.CC_MAP_SYSEX:
+            self.set_modulation_wheel(channel, control, value)
+
+    # Set/Get the time slice of controller thinning
+    def midi_coalesce_ms(self, ms=None):
+        if ms is not None:
+            self.COALESCE_MS = ms if ms > 0 else 0
+            self.midi_coalesce_flush(True)
+
+        return self.COALESCE_MS
+
+    # Control change to send with thinning
+    def coalesce_control_change(self, channel, control, value):
+        if self._cc_map[control] == self.CC_MAP_DROP:
+            return
+
+        # Not a continuous controller, send it after the controllers pending
+        if self._cc_immediate[control]:
+            if self._coalesce_channels[channel]:
+                self.midi_coalesce_flush(True)
+
+            self.midi_control_change(channel, control, value)
+
+            # Reset All Controllers, the values sent before are not on the synthesizer any more
+            if control == 121:
+                self.midi_coalesce_forget(channel)
+            return
+
+        key = channel * 128 + control
+        if self._cc_pending[key] == self.COALESCE_NONE:
+            # Repeated value
+            if value == self._cc_sent[key]:
+                if self._monitor.enabled():
+                    self._monitor.skipped += 1
+                return
+
+            if self.COALESCE_MS == 0:
+                self._cc_sent[key] = value
+                self.midi_control_change(channel, control, value)
+                return
+
+            self._coalesce_add(key, channel)
+
+        # A value pending is replaced
+        elif self._monitor.enabled():
+            self._monitor.skipped += 1
+
+        self._cc_pending[key] = value
+        self._cc_route[key] = self._route
+
+    # Forget the controller values sent (of a channel, or all the channels if None),
+    # the next values are sent even if they are same as before
+    def midi_coalesce_forget(self, channel=None):
+        for ch in (range(16) if channel is None else (channel,)):
+            key = ch * 128
+            for i in range(128):
+                self._cc_sent[key + i] = self.COALESCE_NONE
+
+            self._bend_sent[ch] = None
+
+    # Pitch bend (0..16383) to send with thinning
+    def coalesce_pitch_bend(self, channel, value):
+        if self._bend_pending[channel] is None:
+            # Repeated value
+            if value == self._bend_sent[channel]:
+                if self._monitor.enabled():
+                    self._monitor.skipped += 1
+                return
+
+            if self.COALESCE_MS == 0:
+                self._bend_sent[channel] = value
+                self.set_pitch_bend(channel, value - 8192)
+                return
+
+            self._coalesce_add(self.COALESCE_PITCH_BEND + channel, channel)
+
+        # A value pending is replaced
+        elif self._monitor.enabled():
+            self._monitor.skipped += 1
+
+        self._bend_pending[channel] = value
+        self._bend_route[channel] = self._route
+
+    def _coalesce_add(self, key, channel):
+        if len(self._coalesce_keys) == 0:
+            self._coalesce_t0 = supervisor.ticks_ms()
+
+        self._coalesce_keys.append(key)
+        self._coalesce_channels[channel] += 1
+
+    # Send the controllers pending when the time slice has passed
+    #   force: send them now (before a note on the same channel)
+    def midi_coalesce_flush(self, force=False):
+        keys = self._coalesce_keys
+        if len(keys) == 0:
+            return
+
+        if not force and ticks_diff(supervisor.ticks_ms(), self._coalesce_t0) < self.COALESCE_MS:
+            return
+
+        route = self._route
+        for key in keys:
+            if key >= self.COALESCE_PITCH_BEND:
+                channel = key - self.COALESCE_PITCH_BEND
+                value = self._bend_pending[channel]
+                self._bend_pending[channel] = None
+                if value != self._bend_sent[channel]:
+                    self._bend_sent[channel] = value
+                    self._route = self._bend_route[channel]
+                    self.set_pitch_bend(channel, value - 8192)
+
+            else:
+                channel = key >> 7
+                value = self._cc_pending[key]
+                self._cc_pending[key] = self.COALESCE_NONE
+                if value != self._cc_sent[key]:
+                    self._cc_sent[key] = value
+                    self._route = self._cc_route[key]
+                    self.midi_control_change(channel, key & 0x7F, value)
+
+            self._coalesce_channels[channel] = 0
+
+        del keys[:]
+        self._route = route
+
+    # Play a MIDI message received via USB
+    def midi_dispatch(self, midi_msg):
+        if midi_msg.channel is not None:
+            self._route = self._route_tables[self._route_source][midi_msg.channel]
+
+        # if a NoteOn message...
+        if isinstance(midi_msg, NoteOn):
+            string_msg = 'NoteOn'
+            #  get note number
+            string_val = str(midi_msg.note)
+            if self._coalesce_channels[midi_msg.channel]:
+                self.midi_coalesce_flush(True)
+            self.set_note_on(midi_msg.channel, midi_msg.note, midi_msg.velocity)
+
+        # if a NoteOff message...
+        elif isinstance(midi_msg, NoteOff):
+            string_msg = 'NoteOff'
+            #  get note number
+            string_val = str(midi_msg.note)
+            if self._coalesce_channels[midi_msg.channel]:
+                self.midi_coalesce_flush(True)
+            self.set_note_on(midi_msg.channel, midi_msg.note, 0)
+
+        # if a PitchBend message...
+        elif isinstance(midi_msg, PitchBend):
+            string_msg = 'PitchBend'
+            #  get value of pitchbend
+            val = midi_msg.pitch_bend - 8192
+            if val < -8192:
+                val = -8192
+            elif val > 8191:
+                val = 8191
+                
+            string_val = str(midi_msg.pitch_bend) + '/' + str(val)
+            self.coalesce_pitch_bend(midi_msg.channel, val + 8192)
+            
+        # if a Program Change message...
+        elif isinstance(midi_msg, ProgramChange):
+            string_msg = 'ProgramChange'
+            #  get CC message number
+            string_val = str(midi_msg.patch)
+            if self._coalesce_channels[midi_msg.channel]:
+                self.midi_coalesce_flush(True)
+            self.midi_instrument(midi_msg.channel, midi_msg.patch)
+            
+        #  if a CC message...
+        elif isinstance(midi_msg, ControlChange):
+            string_msg = 'ControlChange'
+            #  get CC message number
+            string_val = str(midi_msg.control)
+            self.coalesce_control_change(midi_msg.channel, midi_msg.control, midi_msg.value)
+
+        else:
+            string_msg = 'Unknown Message'
+            string_val = 'None'
+
+        self._route = self._route_local
+            
+        # update text area with message type and value of message as strings
+        #print(string_msg + ':' + string_val)
+
     def do_task(self):
         led_flush = False
         try:
             led_flush = not led_flush
-            pico_led.value = led_flush
+            pico_led.value(led_flush)
+
+            # Instrumentation
+            monitor = self._monitor.enabled()
+            if monitor:
+                self._monitor.loop(monotonic_ns())
             
+            # USB MIDI host in passthrough mode
+            if self._midi_in_usb and self._usb_host_mode and self._midi_passthrough:
+                num = self.midi_in_passthrough()
+                if monitor:
+                    self.midi_monitor_processed(num)
+
+                self.midi_coalesce_flush()
+                return
+
             # USB MIDI-IN (MIDI-IN mode is auto detected in host mode or device mode)
-            midi_msg = self.midi_in()
+            # All the messages received are played in this pass, so a chord
+            # does not have to wait for the main loop to go round once per note.
+            midi_msgs = self.midi_in()
 
             # MIDI-IN via USB (host or device)
             if self.midi_in_via_usb():
-                if not midi_msg is None:
+                if monitor and len(midi_msgs) > 0:
+                    self.midi_monitor_arrival()
+
+                for midi_msg in midi_msgs:
                     # Receiver USB MIDI-IN
 #	                    print('MIDI IN:', midi_msg)
-                    
-                    # if a NoteOn message...
-                    if isinstance(midi_msg, NoteOn):
-                        string_msg = 'NoteOn'
-                        #  get note number
-                        string_val = str(midi_msg.note)
-                        self.set_note_on(midi_msg.channel, midi_msg.note, midi_msg.velocity)
-
-                    # if a NoteOff message...
-                    elif isinstance(midi_msg, NoteOff):
-                        string_msg = 'NoteOff'
-                        #  get note number
-                        string_val = str(midi_msg.note)
-                        self.set_note_on(midi_msg.channel, midi_msg.note, 0)
-
-                    # if a PitchBend message...
-                    elif isinstance(midi_msg, PitchBend):
-                        string_msg = 'PitchBend'
-                        #  get value of pitchbend
-                        val = midi_msg.pitch_bend - 8192
-                        if val < -8192:
-                            val = -8192
-                        elif val > 8191:
-                            val = 8191
-                            
-                        string_val = str(midi_msg.pitch_bend) + '/' + str(val)
-                        self.set_pitch_bend(midi_msg.channel, val)
-                        
-                    # if a Program Change message...
-                    elif isinstance(midi_msg, ProgramChange):
-                        string_msg = 'ProgramChange'
-                        #  get CC message number
-                        string_val = str(midi_msg.patch)
-                        self.midi_instrument(midi_msg.channel, midi_msg.patch)
-                        
-                    #  if a CC message...
-                    elif isinstance(midi_msg, ControlChange):
-                        string_msg = 'ControlChange'
-                        #  get CC message number
-                        string_val = str(midi_msg.control)
-                        self.set_modulation_wheel(midi_msg.channel, midi_msg.control, midi_msg.value)
+                    self.midi_dispatch(midi_msg)
 
-                    else:
-                        string_msg = 'Unknown Message'
-                        string_val = 'None'
-                        
-                    # update text area with message type and value of message as strings
-                    #print(string_msg + ':' + string_val)
+                if monitor:
+                    self.midi_monitor_processed(len(midi_msgs))
 
             # MIDI-IN via UART (unit1)
             else:
                 # UART1 MIDI-IN
-                if not midi_msg is None:
-                    self.midi_out(midi_msg)
+                if not midi_msgs is None:
+                    self.midi_route_uart1(midi_msgs)
+
+            # Controllers thinned in the time slice
+            self.midi_coalesce_flush()
                 
         except Exception as e:
             print('EXCEPTION: ', e)
+            self.midi_monitor_processed(0)
             display.clear()
             display.show()
             display.text('EXCEPTION: MIDI-IN', 0, 0, 1)
@@ -780,6 +2108,71 @@ class MIDIUnit_class:
 ################# End of Unit-MIDI Class Definition #################
 
 
+#################
+### LED class
+#################
+# LED on board blinking without blocking
+#   A blink pattern is a list of step durations (ms), the LED toggles at every step
+#   starting from the state given. do_task() advances the pattern.
+class LED_class:
+    def __init__(self, pin):
+        self._led = digitalio.DigitalInOut(pin)
+        self._led.direction = digitalio.Direction.OUTPUT
+        self._led.value = True
+        self._value = True
+        self._pattern = None
+        self._first = True
+        self._count = 0
+        self._step = 0
+        self._step_ms = 0
+
+    # Set/Get the LED state shown while no pattern is playing
+    def value(self, flg=None):
+        if flg is None:
+            return self._value
+
+        self._value = flg
+        if self._pattern is None and self._led.value != flg:
+            self._led.value = flg
+
+    # Play a blink pattern count times (replaces the pattern playing)
+    #   first    : LED state of the first step
+    #   durations: duration (ms) of each step
+    def blink(self, first, durations, count=1):
+        self._pattern = durations
+        self._first = first
+        self._count = count
+        self._step = 0
+        self._step_ms = supervisor.ticks_ms()
+        self._led.value = first
+
+    def is_blinking(self):
+        return self._pattern is not None
+
+    # Advance the blink pattern
+    def do_task(self):
+        if self._pattern is None:
+            return
+
+        now = supervisor.ticks_ms()
+        if ticks_diff(now, self._step_ms) < self._pattern[self._step]:
+            return
+
+        self._step_ms = now
+        self._step += 1
+        if self._step >= len(self._pattern):
+            self._step = 0
+            self._count -= 1
+            if self._count <= 0:
+                self._pattern = None
+                self._led.value = self._value
+                return
+
+        self._led.value = self._first if self._step % 2 == 0 else not self._first
+
+################# End of LED Class Definition #################
+
+
 ########################
 ### OLED SSD1306 class
 ########################
@@ -791,6 +2184,8 @@ class OLED_SSD1306_class:
         self.address = address
         self._width = width
         self._height = height
+        self._deferred = False
+        self._dirty = False
 
     def init_device(self, device):
         if device is None:
@@ -827,9 +2222,25 @@ class OLED_SSD1306_class:
         if self.is_available():
             self._display.text(s, x, y, color, font_name='font5x8.bin', size=disp_size)
 
-    def show(self):
+    # Set/Get deferred refresh mode (show() only marks the frame buffer to be sent by refresh())
+    def defer_show(self, flg=None):
+        if flg is None:
+            return self._deferred
+        
+        self._deferred = flg
+
+    def show(self, force=False):
         if self.is_available():
-            self._display.show()
+            if self._deferred and force == False:
+                self._dirty = True
+            else:
+                self._display.show()
+                self._dirty = False
+
+    # Send the frame buffer to the device if it has been changed since the last refresh
+    def refresh(self):
+        if self._dirty:
+            self.show(True)
 
     def clear(self, color=0, refresh=True):
         self.fill(color)
@@ -850,9 +2261,16 @@ class Application_class:
         
         self.DISPLAY_TYPE_SYNTH  = 0
         self.DISPLAY_TYPE_CONFIG = 1
+        self.DISPLAY_TYPE_MONITOR = 2
         self._display_type = self.DISPLAY_TYPE_SYNTH
+
+        # MIDI monitor display is redrawn in this period
+        self.MONITOR_REFRESH_MS = 1000
+        self._monitor_ms = 0
         
         self.COMMAND_MODE_NONE = -999
+        self.COMMAND_MODE_VL = -6
+        self.COMMAND_MODE_RT = -5
         self.COMMAND_MODE_U = -4
         self.COMMAND_MODE_R = -3
         self.COMMAND_MODE_C = -2
@@ -875,6 +2293,12 @@ class Application_class:
         self.COMMAND_MODE_MIDI_IN = 15
         self.COMMAND_MODE_MIDI_OUT_UART0 = 16
         self.COMMAND_MODE_MIDI_OUT_UART1 = 17
+        self.COMMAND_MODE_ROUTE_SOURCE = 18
+        self.COMMAND_MODE_ROUTE_CHANNEL = 19
+        self.COMMAND_MODE_ROUTE_DEST = 20
+        self.COMMAND_MODE_VELOCITY_CURVE = 21
+        self.COMMAND_MODE_VELOCITY_POINT = 22
+        self.COMMAND_MODE_VELOCITY_VALUE = 23
 
         self._command_mode = self.COMMAND_MODE_NONE
         
@@ -883,9 +2307,28 @@ class Application_class:
             [self.COMMAND_MODE_VIBRATE_RATE, self.COMMAND_MODE_VIBRATE_DEPTH, self.COMMAND_MODE_VIBRATE_DELAY],
             [self.COMMAND_MODE_CHANNEL, self.COMMAND_MODE_CHORUS_PROGRAM, self.COMMAND_MODE_CHORUS_LEVEL, self.COMMAND_MODE_CHORUS_FEEDBACK, self.COMMAND_MODE_CHORUS_DELAY],
             [self.COMMAND_MODE_REVERB_PROGRAM, self.COMMAND_MODE_REVERB_LEVEL, self.COMMAND_MODE_REVERB_FEEDBACK],
-            [self.COMMAND_MODE_MIDI_OUT_UART0, self.COMMAND_MODE_MIDI_OUT_UART1]
+            [self.COMMAND_MODE_MIDI_OUT_UART0, self.COMMAND_MODE_MIDI_OUT_UART1],
+            [self.COMMAND_MODE_ROUTE_SOURCE, self.COMMAND_MODE_ROUTE_CHANNEL, self.COMMAND_MODE_ROUTE_DEST],
+            [self.COMMAND_MODE_VELOCITY_CURVE, self.COMMAND_MODE_VELOCITY_POINT, self.COMMAND_MODE_VELOCITY_VALUE]
         ]
 
+        # Routing source to edit on the configuration display
+        self._route_source = 0
+        self.ROUTE_SOURCE_NAMES = ['HST', 'DEV', 'UAT']
+
+        # Velocity curve point to edit on the configuration display
+        self._velocity_point = 0
+        self.VELOCITY_CURVE_NAMES = ['LIN', 'SOF', 'HRD', 'FIX', 'CST']
+
+        # Message queue (error messages are shown by do_task() without blocking)
+        self.MESSAGE_HOLD_MS = 3000
+        self.MESSAGE_REPEAT_MS = 10000
+        self.MESSAGE_QUEUE_SIZE = 4
+        self._messages = []
+        self._message_ms = None
+        self._message_last = None
+        self._message_last_ms = 0
+
     def ignore_midi(self, flg=None):
         if flg is not None:
             self._ignore_midi = flg
@@ -896,15 +2339,85 @@ class Application_class:
         self._display.text(msg, x, y, color)
         self._display.show()
 
+    # Queue a message to show for MESSAGE_HOLD_MS
+    #   A message already queued, or shown within MESSAGE_REPEAT_MS, is not queued again.
+    def queue_message(self, msg):
+        if msg in self._messages or len(self._messages) >= self.MESSAGE_QUEUE_SIZE:
+            return
+
+        if msg == self._message_last and ticks_diff(supervisor.ticks_ms(), self._message_last_ms) < self.MESSAGE_REPEAT_MS:
+            return
+
+        self._messages.append(msg)
+
+    # Show the messages queued one by one
+    def do_task(self):
+        now = supervisor.ticks_ms()
+        if self._message_ms is not None:
+            if ticks_diff(now, self._message_ms) < self.MESSAGE_HOLD_MS:
+                return
+
+            self._message_ms = None
+            self._message_last_ms = now
+            self._display.clear()
+            self.show_midi_channel(True, True)
+
+        if len(self._messages) > 0:
+            msg = self._messages.pop(0)
+            self.show_midi_channel(False, True)
+            self.show_message(msg)
+            self._message_ms = now
+            self._message_last = msg
+            self._message_last_ms = now
+
+        # Update the MIDI monitor display
+        elif self._display_type == self.DISPLAY_TYPE_MONITOR and ticks_diff(now, self._monitor_ms) >= self.MONITOR_REFRESH_MS:
+            self.show_monitor()
+
+    # MIDI monitor display (counts, loop period and latency histogram)
+    def show_monitor(self):
+        self._monitor_ms = supervisor.ticks_ms()
+        monitor = synth.midi_monitor()
+        self._display.fill(0)
+        self._display.text('[M]on:' + ('ON ' if monitor.enabled() else 'OFF') + ' [C]lr [D]mp', 0, 0, 1)
+        self._display.text('IN :{:6d} DRP:{:5d}'.format(monitor.msgs_in % 1000000, monitor.dropped % 100000), 0, 9, 1)
+        self._display.text('OUT:{:6d} SKP:{:5d}'.format(monitor.msgs_out % 1000000, monitor.skipped % 100000), 0, 18, 1)
+        self._display.text('LOOP us:{:5d}/{:5d}'.format(min(monitor.loop_average_us(), 99999), min(monitor.loop_max_us, 99999)), 0, 27, 1)
+
+        # Latency histogram, a bar of each bucket labeled with its lower edge (ms)
+        histogram = monitor.histogram
+        peak = max(histogram)
+        for bucket in range(len(histogram)):
+            x = bucket * 16
+            h = histogram[bucket] * 19 // peak if peak > 0 else 0
+            if h > 0:
+                self._display.fill_rect(x + 2, 55 - h, 12, h, 1)
+
+            self._display.text(str(monitor.LATENCY_EDGES_MS[bucket - 1] if bucket > 0 else 0), x + 2, 56, 1)
+
+        self._display.show()
+
     def channel(self, ch=None):
         if ch is not None:
             self._channel = ch % 16
             
         return self._channel
     
+    def route_source(self, source=None):
+        if source is not None:
+            self._route_source = source % 3
+            
+        return self._route_source
+    
+    def velocity_point(self, point=None):
+        if point is not None:
+            self._velocity_point = point % 5
+            
+        return self._velocity_point
+    
     def display_type(self, disp_type=None):
         if disp_type is not None:
-            self._display_type = disp_type % 2
+            self._display_type = disp_type % 3
             
         return self._display_type
             
@@ -1008,6 +2521,31 @@ class Application_class:
                 else:
                     self._display.text('[UaT]1:OFF', 64, 9, color[self.COMMAND_MODE_MIDI_OUT_UART1])
 
+            elif command == self.COMMAND_MODE_ROUTE_SOURCE:
+                self._display.text('[RS]rc:' + self.ROUTE_SOURCE_NAMES[self._route_source], 0, 18, color[self.COMMAND_MODE_ROUTE_SOURCE])
+
+            elif command == self.COMMAND_MODE_ROUTE_CHANNEL:
+                self._display.text('[RC]h :' + ' {:02d}'.format(channel + 1), 64, 18, color[self.COMMAND_MODE_ROUTE_CHANNEL])
+
+            elif command == self.COMMAND_MODE_ROUTE_DEST:
+                route = synth.midi_route(self._route_source, channel)
+                self._display.text('[RD]st:' + ('0' if route & synth.ROUTE_UART0 else '-') + ('1' if route & synth.ROUTE_UART1 else '-') + ('U' if route & synth.ROUTE_USB else '-'), 0, 27, color[self.COMMAND_MODE_ROUTE_DEST])
+
+            elif command == self.COMMAND_MODE_VELOCITY_CURVE:
+                self._display.text('[VC]rv:' + self.VELOCITY_CURVE_NAMES[synth.midi_velocity_curve(channel)], 64, 27, color[self.COMMAND_MODE_VELOCITY_CURVE])
+
+            elif command == self.COMMAND_MODE_VELOCITY_POINT:
+                self._display.text('[VP]nt:' + '{:03d}'.format(synth.VELOCITY_POINTS[self._velocity_point]), 0, 36, color[self.COMMAND_MODE_VELOCITY_POINT])
+
+            elif command == self.COMMAND_MODE_VELOCITY_VALUE:
+                curve = synth.midi_velocity_curve(channel)
+                if curve == synth.VELOCITY_FIXED:
+                    self._display.text('[VV]al:' + '{:03d}'.format(synth.midi_velocity_value(channel)), 64, 36, color[self.COMMAND_MODE_VELOCITY_VALUE])
+                elif curve == synth.VELOCITY_CUSTOM:
+                    self._display.text('[VV]al:' + '{:03d}'.format(synth.midi_velocity_value(channel, self._velocity_point)), 64, 36, color[self.COMMAND_MODE_VELOCITY_VALUE])
+                else:
+                    self._display.text('[VV]al:---', 64, 36, color[self.COMMAND_MODE_VELOCITY_VALUE])
+
             elif command < 0:
                 if synth.as_host():
                     self._display.text('USB HOST',   0, 0, 1)
@@ -1024,10 +2562,18 @@ class Application_class:
 
 
         #--- show_midi_channel MAIN ---#
+        # MIDI monitor display has no parameters
+        if self._display_type == self.DISPLAY_TYPE_MONITOR:
+            if disp_all and disp == False:
+                self._display.clear()
+            else:
+                self.show_monitor()
+            return
+
         channel = self.channel() if channel is None else channel % 16
         
         # Hilight parameter
-        color = [1] * 18
+        color = [1] * (self.COMMAND_MODE_VELOCITY_VALUE + 1)
         command = self.command_mode()
         hilight = command
         print('COMMAND=', command, ' ALL=', disp_all)
@@ -1056,7 +2602,7 @@ class Application_class:
             # Configuration display
             elif self._display_type == self.DISPLAY_TYPE_CONFIG:
                 show_a_parameter(-1, color)
-                for cmd in list(range(self.COMMAND_MODE_MIDI_IN, self.COMMAND_MODE_MIDI_OUT_UART1 + 1)):
+                for cmd in list(range(self.COMMAND_MODE_MIDI_IN, self.COMMAND_MODE_VELOCITY_VALUE + 1)):
                     show_a_parameter(cmd, color)
 
             # Show display
@@ -1112,6 +2658,15 @@ class CARDKB_class:
         self.command = ''
         self.numeric_param = None
 
+        # Keyboard polling interval (ms), the keyboard task is scheduled on this
+        self.POLL_MS = 10
+        self._poll_ms = self.POLL_MS
+
+        # I2C buffers reused in every poll
+        self._kb_request = bytes([1])
+        self._kb_value = bytearray(1)
+        self.reset_statistics()
+
         self.i2c = i2c
         if self.i2c is None:
             return
@@ -1120,34 +2675,87 @@ class CARDKB_class:
         while not self.i2c.try_lock():
             pass
 
-        for i in self.i2c.scan():
-            print('addr 0x{0:x}'.format(i))
-            if i == self.CARDKB_ADDRESS:
-                self.available = True
-                break
+        try:
+            for i in self.i2c.scan():
+                print('addr 0x{0:x}'.format(i))
+                if i == self.CARDKB_ADDRESS:
+                    self.available = True
+                    break
+
+        finally:
+            self.i2c.unlock()
 
         print("\n")
 
     def is_available(self):
         return self.available
 
-    # Read a key value
+    # Set/Get the keyboard polling interval (ms)
+    def poll_interval(self, ms=None):
+        if ms is None:
+            return self._poll_ms
+
+        self._poll_ms = max(1, ms)
+        if scheduler is not None:
+            task = scheduler.task('KEYBOARD')
+            if task is not None:
+                task.period_ms = self._poll_ms
+
+    # Keyboard I/O statistics
+    def reset_statistics(self):
+        self.io_reads = 0
+        self.io_busy = 0
+        self.io_total_us = 0
+        self.io_max_us = 0
+        self._io_t0 = monotonic_ns()
+
+    # Print how much time the keyboard I/O takes
+    def print_statistics(self):
+        elapsed_us = (monotonic_ns() - self._io_t0) // 1000
+        print('KBD I/O: reads={} busy={} avg={}us max={}us load={}.{:02d}%'.format(
+            self.io_reads, self.io_busy,
+            self.io_total_us // self.io_reads if self.io_reads > 0 else 0, self.io_max_us,
+            self.io_total_us * 100 // elapsed_us if elapsed_us > 0 else 0,
+            self.io_total_us * 10000 // elapsed_us % 100 if elapsed_us > 0 else 0))
+
+    # Read a key value (None if no key is pressed or the I2C bus is busy)
+    #   The value returned is a buffer reused in the next read.
     def read_key(self):
         if self.available:
-            while self.i2c.try_lock():
-                pass
+            if not self.i2c.try_lock():
+                self.io_busy += 1
+                return None
 
-            kb_value = bytearray(1)
-            self.i2c.writeto_then_readfrom(self.CARDKB_ADDRESS, bytes([1]), kb_value)
-            if kb_value[0] != 0x00:
-                return kb_value
+            t0 = monotonic_ns()
+            try:
+                self.i2c.writeto_then_readfrom(self.CARDKB_ADDRESS, self._kb_request, self._kb_value)
+
+            finally:
+                self.i2c.unlock()
+                io_us = (monotonic_ns() - t0) // 1000
+                self.io_reads += 1
+                self.io_total_us += io_us
+                if io_us > self.io_max_us:
+                    self.io_max_us = io_us
+
+            # 0x00 means no key has been pressed since the last read
+            if self._kb_value[0] != 0x00:
+                return self._kb_value
 
         return None
 
+    # Change the channel to edit, the notes sounding in the channel left are released
+    def change_channel(self, ch):
+        channel = application.channel()
+        if ch % 16 != channel:
+            synth.set_all_notes_off(channel)
+
+        application.channel(ch)
+
     def change_parameter_value(self, delta, abs_value=None):
         if   application.command_mode() == application.COMMAND_MODE_CHANNEL:
             application.show_midi_channel(False, True)
-            application.channel((application.channel() if abs_value is None else abs_value) + (1 if delta > 0 else -1))
+            self.change_channel((application.channel() if abs_value is None else abs_value) + (1 if delta > 0 else -1))
         
         elif application.command_mode() == application.COMMAND_MODE_PROGRAM:
             synth.midi_instrument(application.channel(), (synth.midi_get_instrument(application.channel()) if abs_value is None else abs_value) + delta)
@@ -1207,6 +2815,34 @@ class CARDKB_class:
         elif application.command_mode() == application.COMMAND_MODE_MIDI_OUT_UART1:
             synth.midi_out_to(1, not synth.midi_out_to(1))
 
+        elif application.command_mode() == application.COMMAND_MODE_ROUTE_SOURCE:
+            application.route_source((application.route_source() if abs_value is None else abs_value) + (0 if delta == 0 else (1 if delta > 0 else -1)))
+            application.show_midi_channel(True, True)
+
+        elif application.command_mode() == application.COMMAND_MODE_ROUTE_CHANNEL:
+            self.change_channel((application.channel() if abs_value is None else abs_value - 1) + (0 if delta == 0 else (1 if delta > 0 else -1)))
+            application.show_midi_channel(True, True)
+
+        elif application.command_mode() == application.COMMAND_MODE_ROUTE_DEST:
+            value = (synth.midi_route(application.route_source(), application.channel()) if abs_value is None else abs_value) + (0 if delta == 0 else (1 if delta > 0 else -1))
+            synth.midi_route(application.route_source(), application.channel(), value % 8)
+
+        elif application.command_mode() == application.COMMAND_MODE_VELOCITY_CURVE:
+            value = (synth.midi_velocity_curve(application.channel()) if abs_value is None else abs_value) + (0 if delta == 0 else (1 if delta > 0 else -1))
+            synth.midi_velocity_curve(application.channel(), value)
+            application.show_midi_channel(True, True)
+
+        elif application.command_mode() == application.COMMAND_MODE_VELOCITY_POINT:
+            application.velocity_point((application.velocity_point() if abs_value is None else abs_value - 1) + (0 if delta == 0 else (1 if delta > 0 else -1)))
+            application.show_midi_channel(True, True)
+
+        elif application.command_mode() == application.COMMAND_MODE_VELOCITY_VALUE:
+            curve = synth.midi_velocity_curve(application.channel())
+            point = application.velocity_point() if curve == synth.VELOCITY_CUSTOM else None
+            if curve == synth.VELOCITY_FIXED or curve == synth.VELOCITY_CUSTOM:
+                value = (synth.midi_velocity_value(application.channel(), point) if abs_value is None else abs_value) + delta
+                synth.midi_velocity_value(application.channel(), point, value)
+
         # Redraw the parameter only or all (if COMMAND_MODE_CHANNEL)
         application.show_midi_channel(True, application.command_mode() == application.COMMAND_MODE_CHANNEL)
 
@@ -1230,6 +2866,11 @@ class CARDKB_class:
             # Ignore MIDI or NOT
             elif key_code == 0x1b:
                 application.ignore_midi(not application.ignore_midi())
+
+                # The note offs will be ignored, release the notes sounding now (panic)
+                if application.ignore_midi():
+                    synth.midi_out_end_stream()
+                    synth.set_all_notes_off()
             
             # Value increment
             elif key_code == 0xB7:
@@ -1267,20 +2908,13 @@ class CARDKB_class:
             elif key_code == 0x20 or key_code == 0xAF:
                 if key_code == 0xAF:
                     print('RESED instruments and effecrors settings.')
-                    synth.midi_instrument()
-                    synth.midi_effectors()
+                    synth.midi_send_settings(True)
 
                 print('PROGRAM/VOLUME: ', synth.midi_get_instrument(0), synth.midi_master_volume())
-                synth.set_note_on(application.channel(), 60, 127)
-                sleep(0.5)
-                synth.set_note_on(application.channel(), 64, 127)
-                sleep(0.5)
-                synth.set_note_on(application.channel(), 67, 127)
-                sleep(0.5)
-                synth.set_note_off(application.channel(), 60)
-                synth.set_note_off(application.channel(), 64)
-                synth.set_note_off(application.channel(), 67)
-                synth.set_all_notes_off()
+                channel = application.channel()
+                for i, note_key in enumerate((60, 64, 67)):
+                    sequencer.schedule(i * 500, bytes([0x90 + channel, note_key, 127]))
+                    sequencer.schedule(1500, bytes([0x90 + channel, note_key, 0]))
 
             elif (('0' <= ch and ch <= '9') or key_code == 0x0d or key_code == 0x08) and application.command_mode() != application.COMMAND_MODE_NONE:
                 if key_code == 0x0d:
@@ -1339,8 +2973,7 @@ class CARDKB_class:
                         synth.load_midi_settings()
                         application.show_midi_channel(True, True)
                         application.command_mode(application.COMMAND_MODE_NONE)
-                        synth.midi_instrument()
-                        synth.midi_effectors()
+                        synth.midi_send_settings()
                         self.command = ''
                         self.numeric_param = None
                         
@@ -1448,26 +3081,299 @@ class CARDKB_class:
                         application.command_mode(application.COMMAND_MODE_MIDI_OUT_UART1)
                         self.numeric_param = None
                         
+                    elif self.command == 'R':
+                        application.command_mode(application.COMMAND_MODE_RT)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'RS':
+                        application.command_mode(application.COMMAND_MODE_ROUTE_SOURCE)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'RC':
+                        application.command_mode(application.COMMAND_MODE_ROUTE_CHANNEL)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'RD':
+                        application.command_mode(application.COMMAND_MODE_ROUTE_DEST)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'V':
+                        application.command_mode(application.COMMAND_MODE_VL)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'VC':
+                        application.command_mode(application.COMMAND_MODE_VELOCITY_CURVE)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'VP':
+                        application.command_mode(application.COMMAND_MODE_VELOCITY_POINT)
+                        self.numeric_param = None
+                        
+                    elif self.command == 'VV':
+                        application.command_mode(application.COMMAND_MODE_VELOCITY_VALUE)
+                        self.numeric_param = None
+                        
                     elif ch == 'U':
                         application.command_mode(application.COMMAND_MODE_U)
                         self.command = ch
                         self.numeric_param = None
                     
+                    elif ch == 'R':
+                        application.command_mode(application.COMMAND_MODE_RT)
+                        self.command = ch
+                        self.numeric_param = None
+                    
+                    elif ch == 'V':
+                        application.command_mode(application.COMMAND_MODE_VL)
+                        self.command = ch
+                        self.numeric_param = None
+                    
                     else:
                         application.command_mode(application.COMMAND_MODE_NONE)
                         self.command = ''
                         self.numeric_param = None
 
+                # MIDI monitor display
+                elif application.display_type() == application.DISPLAY_TYPE_MONITOR:
+                    monitor = synth.midi_monitor()
+                    if ch == 'M':
+                        monitor.enabled(not monitor.enabled())
+
+                    elif ch == 'C':
+                        monitor.reset()
+
+                    elif ch == 'D':
+                        synth.midi_monitor_dump()
+                        scheduler.print_statistics()
+                        cardkb.print_statistics()
+
+                    application.show_monitor()
+
 ################# End of CARD.KB Class Definition #################
     
 
+#####################
+### Sequencer class
+#####################
+# Timed MIDI event scheduler
+#   Events (due time, message) are kept in a binary heap ordered by the due time
+#   (time.monotonic_ns), events due at the same time are sent in order of scheduling.
+#   do_task() sends the events due without blocking.
+class Sequencer_class:
+    # Constructor
+    #   send: function sending a MIDI message
+    def __init__(self, send):
+        self._send = send
+        self._heap = []			# [due_ns, sequence number, message]
+        self._sequence = 0
+
+    # Number of the events waiting
+    def pending(self):
+        return len(self._heap)
+
+    def is_empty(self):
+        return len(self._heap) == 0
+
+    # Schedule a message to send at due_ns (time.monotonic_ns)
+    def schedule_at(self, due_ns, midi_msg):
+        heap = self._heap
+        heap.append([due_ns, self._sequence, midi_msg])
+        self._sequence += 1
+
+        # Sift up
+        pos = len(heap) - 1
+        while pos > 0:
+            parent = (pos - 1) >> 1
+            if not self._earlier(heap[pos], heap[parent]):
+                break
+
+            heap[pos], heap[parent] = heap[parent], heap[pos]
+            pos = parent
+
+    # Schedule a message to send delay_ms later
+    def schedule(self, delay_ms, midi_msg):
+        self.schedule_at(monotonic_ns() + int(delay_ms * 1000000), midi_msg)
+
+    # Discard all the events waiting
+    def clear(self):
+        self._heap = []
+
+    # Event e1 is earlier than e2 or not
+    def _earlier(self, e1, e2):
+        return e1[0] < e2[0] or (e1[0] == e2[0] and e1[1] < e2[1])
+
+    # Remove the earliest event
+    def _pop(self):
+        heap = self._heap
+        last = heap.pop()
+        if len(heap) == 0:
+            return
+
+        heap[0] = last
+
+        # Sift down
+        size = len(heap)
+        pos = 0
+        while True:
+            child = pos * 2 + 1
+            if child >= size:
+                break
+
+            if child + 1 < size and self._earlier(heap[child + 1], heap[child]):
+                child += 1
+
+            if not self._earlier(heap[child], heap[pos]):
+                break
+
+            heap[pos], heap[child] = heap[child], heap[pos]
+            pos = child
+
+    # Send the events due
+    def do_task(self):
+        if len(self._heap) == 0:
+            return
+
+        now = monotonic_ns()
+        heap = self._heap
+        while len(heap) > 0 and heap[0][0] <= now:
+            midi_msg = heap[0][2]
+            self._pop()
+            self._send(midi_msg)
+
+################# End of Sequencer Class Definition #################
+
+
+#####################
+### Scheduler class
+#####################
+# A task called every period_ms by the scheduler
+class Task_class:
+    def __init__(self, name, func, period_ms, priority):
+        self.name = name
+        self.func = func
+        self.period_ms = period_ms
+        self.priority = priority
+        self.last_ms = supervisor.ticks_ms()
+        self.reset_statistics()
+
+    def reset_statistics(self):
+        self.runs = 0
+        self.total_us = 0
+        self.max_us = 0
+        self.max_late_ms = 0
+
+    # Due to run at now (ticks_ms)
+    def is_due(self, now):
+        return ticks_diff(now, self.last_ms) >= self.period_ms
+
+    # Average run time in micro seconds
+    def average_us(self):
+        if self.runs == 0:
+            return 0
+
+        return self.total_us // self.runs
+
+
+# Cooperative scheduler on asyncio
+#   Each task runs as an asyncio task every period_ms (0 means every pass).
+#   A task steps aside while a periodic task with higher priority is due, so tasks
+#   due at the same time run in order of priority. Tasks running every pass
+#   never hold the others back.
+#   Run time (us) and lateness (ms) are measured for each task.
+class Scheduler_class:
+    def __init__(self):
+        self._tasks = []
+        self._error_handler = None
+
+    # Add a task, larger priority runs first
+    def add_task(self, name, func, period_ms, priority=0):
+        task = Task_class(name, func, period_ms, priority)
+        self._tasks.append(task)
+        return task
+
+    # Get a task by name
+    def task(self, name):
+        for task in self._tasks:
+            if task.name == name:
+                return task
+
+        return None
+
+    def tasks(self):
+        return self._tasks
+
+    # Set/Get the error handler called with an exception raised in a task
+    def error_handler(self, func=None):
+        if func is None:
+            return self._error_handler
+
+        self._error_handler = func
+
+    # Is a periodic task with higher priority than the priority due at now
+    def _higher_due(self, priority, now):
+        for task in self._tasks:
+            if task.priority > priority and task.period_ms > 0 and task.is_due(now):
+                return True
+
+        return False
+
+    async def _run_task(self, task):
+        while True:
+            now = supervisor.ticks_ms()
+            wait_ms = task.period_ms - ticks_diff(now, task.last_ms)
+            if wait_ms > 0:
+                await asyncio.sleep(wait_ms / 1000)
+                continue
+
+            if self._higher_due(task.priority, now):
+                await asyncio.sleep(0)
+                continue
+
+            # Lateness from the time due
+            if task.period_ms > 0 and -wait_ms > task.max_late_ms:
+                task.max_late_ms = -wait_ms
+
+            task.last_ms = now
+            t0 = monotonic_ns()
+            try:
+                task.func()
+
+            except Exception as e:
+                if self._error_handler is None:
+                    raise
+
+                self._error_handler(e)
+
+            run_us = (monotonic_ns() - t0) // 1000
+            task.runs += 1
+            task.total_us += run_us
+            if run_us > task.max_us:
+                task.max_us = run_us
+
+            await asyncio.sleep(0)
+
+    # Run all tasks (never returns)
+    async def run(self):
+        await asyncio.gather(*[asyncio.create_task(self._run_task(task)) for task in self._tasks])
+
+    def reset_statistics(self):
+        for task in self._tasks:
+            task.reset_statistics()
+
+    # Print timing of the tasks
+    def print_statistics(self):
+        print('TASK     PERIOD PRI   RUNS  AVGus  MAXus LATEms')
+        for task in self._tasks:
+            print('{:8s} {:6d} {:3d} {:6d} {:6d} {:6d} {:6d}'.format(task.name, task.period_ms, task.priority, task.runs, task.average_us(), task.max_us, task.max_late_ms))
+
+################# End of Scheduler Class Definition #################
+
+
 def setup():
-    global pico_led, sdcard, synth, display, cardkb, view, application
+    global pico_led, sdcard, synth, display, cardkb, view, application, sequencer
 
     # LED on board
-    pico_led = digitalio.DigitalInOut(GP25)
-    pico_led.direction = digitalio.Direction.OUTPUT
-    pico_led.value = True
+    pico_led = LED_class(GP25)
 
     # OLED SSD1306
     print('setup')
@@ -1484,13 +3390,8 @@ def setup():
         
     except:
         display = OLED_SSD1306_class(None)
-        pico_led.value = False
         print('ERROR I2C1')
-        for cnt in list(range(10)):
-            pico_led.value = False
-            sleep(0.5)
-            pico_led.value = True
-            sleep(1.0)
+        pico_led.blink(False, (500, 1000), 10)
 
     print('Start application.')
     application = Application_class(display)
@@ -1506,13 +3407,8 @@ def setup():
         cardkb = CARDKB_class(i2c0)
         if cardkb.is_available() == False:
             print('CARD.KB not availalbe.')
-            application.show_midi_channel(False, True)
-            application.show_message('NO KEYBOARD.')
-            for cnt in list(range(10)):
-                pico_led.value = True
-                sleep(1.0)
-                pico_led.value = False
-                sleep(0.5)
+            application.queue_message('NO KEYBOARD.')
+            pico_led.blink(True, (1000, 500), 10)
 
         else:
             print('Keyboard ready.')
@@ -1525,26 +3421,74 @@ def setup():
     except:
         cardkb = CARDKB_class(None)
         print('ERROR I2C0')
-        application.show_midi_channel(False, True)
-        application.show_message('ERROR I2C0')
-        for cnt in list(range(10)):
-            pico_led.value = True
-            sleep(1.0)
-            pico_led.value = False
-            sleep(0.5)
+        application.queue_message('ERROR I2C0')
+        pico_led.blink(True, (1000, 500), 10)
 
     # Unit Synthesizer
     synth = MIDIUnit_class(0, (GP0, GP1))
+    sequencer = Sequencer_class(synth.midi_send_event)
     synth.look_for_usb_midi_device()
     synth.midi_master_volume(127)
-    synth.midi_instrument()
-    synth.midi_effectors()
+    synth.midi_send_settings(True)
     sleep(1.0)
     display.clear()
     display.show()
     
     application.show_midi_channel(True, True)
-    synth.set_all_notes_off()
+
+    # Nothing is tracked yet, the synthesizer may still have notes from before the reset
+    synth.set_all_notes_off(untracked=True)
+
+
+# Show an exception raised in a task
+def task_error(e):
+    print('CATCH EXCEPTION:', e)
+    application.queue_message('ERROR: ' + str(e))
+    pico_led.blink(False, (500, 1000), 10)
+
+
+# MIDI pump task
+def midi_task():
+    # Unit SYNTH task
+    if application.ignore_midi() == False:
+        synth.do_task()
+
+    # Generated notes due
+    sequencer.do_task()
+
+    # Send MIDI-OUT queued as far as the UARTs can take without blocking
+    synth.midi_out_flush()
+
+
+# CARD.KB task (polls the keyboard once per slot)
+def keyboard_task():
+    cardkb.do_task()
+
+
+# Display refresh task (shows the messages queued)
+def display_task():
+    application.do_task()
+    display.refresh()
+
+
+# LED blink task
+def led_task():
+    pico_led.do_task()
+
+
+async def main():
+    global scheduler
+
+    scheduler = Scheduler_class()
+    scheduler.error_handler(task_error)
+    scheduler.add_task('MIDI', midi_task, 0, 2)
+    scheduler.add_task('KEYBOARD', keyboard_task, cardkb.poll_interval(), 1)
+    scheduler.add_task('DISPLAY', display_task, 50, 0)
+    scheduler.add_task('LED', led_task, 20, 0)
+
+    # The display is refreshed by the display task from here
+    display.defer_show(True)
+    await scheduler.run()
 
 
 ######### MAIN ##########
@@ -1556,30 +3500,8 @@ if __name__=='__main__':
     display = None
     cardkb = None
     application = None
+    scheduler = None
+    sequencer = None
     setup()
 
-    while True:
-        try:
-            # CARD.KB task
-            cardkb.do_task()
-            
-            # Unit SYNTH task
-            if application.ignore_midi() == False:
-                synth.do_task()
-
-        except Exception as e:
-            print('CATCH EXCEPTION:', e)
-            application.show_midi_channel(False, True)
-            application.show_message('ERROR: ' + str(e))
-            for cnt in list(range(10)):
-                pico_led.value = False
-                sleep(0.5)
-                pico_led.value = True
-                sleep(1.0)
-
-            display.clear()
-            application.show_midi_channel(True, True)
-
-
-
-
+    asyncio.run(main())